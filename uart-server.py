@@ -7,7 +7,7 @@ from gi.repository import GLib
 
 from advertisement import Advertisement
 from advertisement import register_ad_cb, register_ad_error_cb
-from gatt_server   import Service, Characteristic
+from gatt_server   import Service, Characteristic, Application
 from gatt_server   import register_app_cb, register_app_error_cb
 
 BLUEZ_SERVICE_NAME =           'org.bluez'
@@ -30,7 +30,7 @@ class TxCharacteristic(Characteristic):
     def __init__(self, bus, index, service):
 
         Characteristic.__init__(self, bus, index, UART_TX_CHARACTERISTIC_UUID,
-                                ['notify'], service)
+                                ['notify'], service, acquire_notify=True)
         self.notifying = False
         GLib.io_add_watch(sys.stdin, GLib.IO_IN, self.on_console_input)
         self.uart_fd = uart.fileno()
@@ -41,16 +41,13 @@ class TxCharacteristic(Characteristic):
         if s.isspace():
             pass
         else:
-            self.send_tx(s)
+            self.send_tx(s.encode())
         return True
 
-    def send_tx(self, s):
+    def send_tx(self, data):
         if not self.notifying:
             return
-        value = []
-        for c in s:
-            value.append(dbus.Byte(c.encode()))
-        self.PropertiesChanged(GATT_CHRC_IFACE, {'Value': value}, [])
+        self.notify_value(data)
         
     def read_from_uart_helper(self, fd, condition):
         return self.read_from_uart()
@@ -58,7 +55,7 @@ class TxCharacteristic(Characteristic):
     def read_from_uart(self):
         data = uart.read(uart.inWaiting())
         if data:
-            self.send_tx(data.decode())
+            self.send_tx(data)
         return True
 
     def StartNotify(self):
@@ -74,10 +71,12 @@ class TxCharacteristic(Characteristic):
 
 class RxCharacteristic(Characteristic):
     def __init__(self, bus, index, service):
-        Characteristic.__init__(self, bus, index, UART_RX_CHARACTERISTIC_UUID,['write'], service)
+        Characteristic.__init__(self, bus, index, UART_RX_CHARACTERISTIC_UUID,
+                                ['write', 'write-without-response'], service,
+                                acquire_write=True)
 
     def WriteValue(self, value, options):
-        print('remote: {}'.format(bytearray(value).decode()))
+        print('remote: {}'.format(value.decode(errors='replace')))
         try:
             uart.write(value)
         except Exception as e:
@@ -91,29 +90,6 @@ class UartService(Service):
         self.add_characteristic(RxCharacteristic(bus, 1, self))
 
 
-class Application(dbus.service.Object):
-    def __init__(self, bus):
-        self.path = '/'
-        self.services = []
-        dbus.service.Object.__init__(self, bus, self.path)
-
-    def get_path(self):
-        return dbus.ObjectPath(self.path)
-
-    def add_service(self, service):
-        self.services.append(service)
-
-    @dbus.service.method(DBUS_OM_IFACE, out_signature='a{oa{sa{sv}}}')
-    def GetManagedObjects(self):
-        response = {}
-        for service in self.services:
-            response[service.get_path()] = service.get_properties()
-            chrcs = service.get_characteristics()
-            for chrc in chrcs:
-                response[chrc.get_path()] = chrc.get_properties()
-        return response
-
-
 class UartApplication(Application):
     def __init__(self, bus):
         Application.__init__(self, bus)
@@ -5,16 +5,20 @@ import usb.core
 import usb.util
 import threading
 import time
-import queue
 import traceback
+import queue
 import serial
 
+import usb_hotplug
+import byte_queue
+from spool import Spool
+
 # Configure these values based on your setup
 arduino_port = '/dev/ttyS0'  # UART port for Raspberry Pi
 baud_rate = 115200             # Match this with your Arduino's baud rate
 last_uart_activity = time.time()
-# Setup the serial connection
-uart = serial.Serial(arduino_port, baudrate=baud_rate, timeout=1)
+# Serial connection, opened by main()
+uart = None
 
 #  Product IDs / Vendor IDs 
 AOA_ACCESSORY_VENDOR_ID		            =0x18D1	    # Google 
@@ -32,10 +36,30 @@ ACCESSORY_PIDS = {0x2D00, 0x2D01}  # Accessory mode product IDs
 # Flag to control the communication thread
 running = True
 
-# Create a thread-safe queue
-MAX_QUEUE_SIZE = 100
-message_queue_to_uart = queue.Queue()
-message_queue_to_usb = queue.Queue()
+# Wakes the rescans up when a device is plugged in or re-enumerates
+watcher = None
+RESCAN_INTERVAL = 3             # Seconds between bus scans when no device arrives
+ACCESSORY_SWITCH_TIMEOUT = 2    # Seconds a phone gets to re-enumerate in accessory mode
+ACCESSORY_POLL_INTERVAL = 0.1   # Seconds between looks for it when hotplug is unavailable
+
+# Endpoint layout of the last accessory, a returning one skips the descriptor lookup
+last_layout = None              # (port, idProduct, in address, in max packet, out address, out max packet)
+attached_at = None              # time.monotonic() of the last attach, until its first byte
+
+# Create thread-safe queues, bounded by bytes held
+MAX_QUEUE_BYTES = 64 * 1024
+QUEUE_POLICY = byte_queue.DROP_OLDEST   # or byte_queue.DROP_NEWEST, byte_queue.BLOCK
+QUEUE_PUT_TIMEOUT = 1                   # Seconds a producer waits for room with BLOCK
+QUEUE_GET_TIMEOUT = 1                   # Seconds a consumer waits before checking whether to stop
+message_queue_to_uart = byte_queue.ByteQueue(MAX_QUEUE_BYTES, QUEUE_POLICY)
+message_queue_to_usb = byte_queue.ByteQueue(MAX_QUEUE_BYTES, QUEUE_POLICY)
+
+# UART data that arrives with no accessory attached is kept on disk and
+# replayed to the next one before anything live
+SPOOL_PATH = None               # e.g. '/home/jorge/usb_comms/uart.spool', None = no spooling
+spool = None                    # Spool, opened by main()
+spool_lock = threading.Lock()   # Guards spool and accessory_attached
+accessory_attached = False
 
 def monitor_threads():
     global uart
@@ -58,22 +82,68 @@ def monitor_threads():
                 print(f"Exception occured while restarting UART threads: {e}")
         time.sleep(2)  # Check every 2 seconds
 
-# Function to clear the queue
-def clear_queue(q):
-    with q.mutex:  # Acquire the queue's underlying lock to ensure thread-safe operations
-        q.queue.clear()  # Directly clear the underlying deque
-        
+def report_queues():
+    print("Queue to UART:", message_queue_to_uart.stats())
+    print("Queue to USB:", message_queue_to_usb.stats())
+    if spool is not None:
+        print("Spool:", spool.stats())
+
+def set_accessory_attached(attached):
+    global accessory_attached
+    with spool_lock:
+        accessory_attached = attached
+        if spool is not None and not attached:
+            # What the writer didn't get to goes ahead of what is spooled next
+            try:
+                for data in message_queue_to_usb.get_batch(timeout=0):
+                    spool.append(data)
+            except queue.Empty:
+                pass
+
+def replay_spool(endpoint_out):
+    # Send what was spooled while detached, in writes as large as the queue
+    # allows, before the writer takes live data. Records only leave the
+    # spool once their write went through, a failed one leaves the rest for
+    # the next accessory
+    if spool is None:
+        return
+    start = time.monotonic()
+    count = 0
+    batch = bytearray()
+    try:
+        for end, data in spool.peek():
+            count += 1
+            batch += data
+            if len(batch) >= MAX_QUEUE_BYTES:
+                endpoint_out.write(batch)
+                spool.release(end)
+                batch.clear()
+        if batch:
+            endpoint_out.write(batch)
+            spool.release(end)
+    finally:
+        spool.flush()
+    if count:
+        print(f"Replayed {count} spooled messages in {(time.monotonic() - start) * 1000:.1f} ms")
+
 def read_from_uart():
     global uart, last_uart_activity
     while True:
         try:
-            # print("trying to read from uart")
-            bytes_to_read = uart.in_waiting
-            if bytes_to_read:
-                data = uart.read(bytes_to_read)
-                if(message_queue_to_usb.qsize() > MAX_QUEUE_SIZE):
-                    clear_queue(message_queue_to_usb)
-                message_queue_to_usb.put(data)
+            # Block for the first byte (up to the port timeout), then take
+            # whatever else has arrived with it
+            data = uart.read(1)
+            if data:
+                bytes_to_read = uart.in_waiting
+                if bytes_to_read:
+                    data += uart.read(bytes_to_read)
+                # Under the lock, so a detach can't slip in between the
+                # check and the put and reorder the queue and the spool
+                with spool_lock:
+                    if spool is not None and not accessory_attached:
+                        spool.append(data)
+                    else:
+                        message_queue_to_usb.put(data, timeout=QUEUE_PUT_TIMEOUT)
                 last_uart_activity = time.time()  # Update activity timestamp
                 # print("Received data from UART:", data)
         except serial.SerialException as e:
@@ -87,11 +157,12 @@ def send_messages_from_queue():
     global uart
     while True:
         try:
-            # print("trying to send to uart")
-            if not message_queue_to_uart.empty():
-                message_to_send = message_queue_to_uart.get()
-                print("Sending data to UART:", message_to_send)
-                uart.write(message_to_send)
+            # Everything queued goes out in one write
+            message_to_send = b"".join(message_queue_to_uart.get_batch(timeout=QUEUE_GET_TIMEOUT))
+            print("Sending data to UART:", message_to_send)
+            uart.write(message_to_send)
+        except queue.Empty:
+            continue
         except serial.SerialException as e:
             print(f"Serial exception during write: {e}. Waiting for reconnection...")
             # Wait a bit for the read thread to re-establish the connection
@@ -164,8 +235,7 @@ def attempt_accessory_mode_for_device(dev):
         if send_accessory_mode_commands(dev):
             # Wait for the device to disconnect and reconnect
             print("Waiting for device to switch to accessory mode...")
-            time.sleep(1) 
-            accessory = find_accessory_device()
+            accessory = wait_for_accessory_device()
             if accessory is not None:
                 print("Device found in accessory mode:", accessory)
                 return accessory  # Return the device if accessory mode command was successful
@@ -200,6 +270,19 @@ def identify_android_device_as_usb():
         return None
 
 
+def wait_for_accessory_device(timeout=ACCESSORY_SWITCH_TIMEOUT):
+    # Look for the accessory each time a device arrives, until timeout
+    deadline = time.monotonic() + timeout
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+        watcher.wait(remaining if watcher.events else ACCESSORY_POLL_INTERVAL)
+        accessory = find_accessory_device()
+        if accessory is not None:
+            return accessory
+
+
 def find_accessory_device():
     try:
         dev = usb.core.find(idVendor=GOOGLE_VID, find_all=True)
@@ -210,6 +293,40 @@ def find_accessory_device():
     except usb.core.USBError as e:
         return None
 
+def device_identity(dev):
+    # Port the device is plugged into, survives the switch to accessory mode
+    ports = dev.port_numbers or (dev.address,)
+    return "{}-{}".format(dev.bus, ".".join(str(port) for port in ports))
+
+class EndpointRef:
+    # Bulk endpoint known only by its address
+    def __init__(self, device, address, max_packet):
+        self.device = device
+        self.bEndpointAddress = address
+        self.wMaxPacketSize = max_packet
+
+    def read(self, size_or_buffer, timeout=None):
+        return self.device.read(self.bEndpointAddress, size_or_buffer, timeout)
+
+    def write(self, data, timeout=None):
+        return self.device.write(self.bEndpointAddress, data, timeout)
+
+def get_accessory_endpoints(accessory):
+    # Reuse the last accessory's endpoint addresses if it is back on the same port
+    global last_layout
+    identity = device_identity(accessory)
+    if last_layout is not None and last_layout[:2] == (identity, accessory.idProduct):
+        _, _, in_address, in_size, out_address, out_size = last_layout
+        print("Reattaching", identity, "with cached endpoints")
+        return EndpointRef(accessory, in_address, in_size), EndpointRef(accessory, out_address, out_size)
+
+    endpoint_in, endpoint_out = get_bulk_endpoints(accessory, 0)
+    if endpoint_in is not None and endpoint_out is not None:
+        last_layout = (identity, accessory.idProduct,
+                       endpoint_in.bEndpointAddress, endpoint_in.wMaxPacketSize,
+                       endpoint_out.bEndpointAddress, endpoint_out.wMaxPacketSize)
+    return endpoint_in, endpoint_out
+
 # Function to get bulk endpoints
 def get_bulk_endpoints(accessory_device, interface_number):
     cfg = accessory_device.get_active_configuration()
@@ -226,15 +343,16 @@ def get_bulk_endpoints(accessory_device, interface_number):
     return ep_in, ep_out
 
 def read_from_accessory(device, endpoint_in):
-    global running
+    global running, attached_at
     while running:
         try:
             data = endpoint_in.read(1024, timeout=1000)  # Read up to 1024 bytes with a timeout
+            if attached_at is not None:
+                print(f"Attach to first byte: {(time.monotonic() - attached_at) * 1000:.1f} ms")
+                attached_at = None
             data_string = data.tobytes().decode('utf-8', errors='replace')
             # print("Received data from USB:", data_string)
-            if(message_queue_to_uart.qsize() > MAX_QUEUE_SIZE):
-                    clear_queue(message_queue_to_uart)
-            message_queue_to_uart.put(data.tobytes())  # Enqueue the received data
+            message_queue_to_uart.put(data.tobytes(), timeout=QUEUE_PUT_TIMEOUT)  # Enqueue the received data
         except usb.core.USBError as e:
             if e.errno == 110:
                 # print("Read timeout. Continuing...")
@@ -250,9 +368,18 @@ def read_from_accessory(device, endpoint_in):
 
 def write_to_accessory(device, endpoint_out):
     global running, message_queue_to_usb
+    try:
+        replay_spool(endpoint_out)
+    except usb.core.USBError as e:
+        print("Spool replay USB error:", e)
+        running = False  # Stop the threads
+        return
     while running:
-        if not message_queue_to_usb.empty():
-            data = message_queue_to_usb.get()  # Dequeue the data
+        try:
+            data = b"".join(message_queue_to_usb.get_batch(timeout=QUEUE_GET_TIMEOUT))  # Dequeue all the data
+        except queue.Empty:
+            continue
+        if data:
             try:
                 # endpoint_out.write(data_string.encode('utf-8')) # for string data encode first
                 endpoint_out.write(data)
@@ -284,7 +411,14 @@ def write_to_uart():
                     from_arduino.put(data)
         
 def main():
-    global running
+    global running, watcher, attached_at, uart, spool
+
+    # Setup the serial connection
+    uart = serial.Serial(arduino_port, baudrate=baud_rate, timeout=1)
+    if SPOOL_PATH is not None:
+        spool = Spool(SPOOL_PATH)
+
+    watcher = usb_hotplug.DeviceWatcher()
     
     # Create and start threads
     read_uart_thread = threading.Thread(target=read_from_uart)
@@ -304,14 +438,11 @@ def main():
             try:
                 
                 print("Step 1 done")
-                # Get endpoints based on product ID
-                if accessory.idProduct == 0x2D00:
-                    endpoint_in, endpoint_out = get_bulk_endpoints(accessory, 0)
-                elif accessory.idProduct == 0x2D01:
-                    # Standard communication endpoints
-                    endpoint_in, endpoint_out = get_bulk_endpoints(accessory, 0)
-                    # ADB communication endpoints (if needed)
-                    # adb_ep_in, adb_ep_out = get_bulk_endpoints(accessory, 1)
+                attached_at = time.monotonic()
+                # Standard communication endpoints, interface 0 for 0x2D00 and 0x2D01
+                endpoint_in, endpoint_out = get_accessory_endpoints(accessory)
+                # ADB communication endpoints (if needed)
+                # adb_ep_in, adb_ep_out = get_bulk_endpoints(accessory, 1)
 
                 print("Step 2 done")
 
@@ -319,14 +450,17 @@ def main():
                     read_thread = threading.Thread(target=read_from_accessory, args=(accessory, endpoint_in))
                     write_thread = threading.Thread(target=write_to_accessory, args=(accessory, endpoint_out))
 
+                    set_accessory_attached(True)
                     read_thread.start()
                     write_thread.start()
                     print("Threads started")
 
                     read_thread.join()
                     write_thread.join()
+                    set_accessory_attached(False)
 
                     print("Continue Main loop after finish")
+                    report_queues()
                 else:
                     print("Endpoints not found.")
             except usb.core.USBError as e:
@@ -342,7 +476,7 @@ def main():
         else:
             print("No Android device found in accessory mode.")
             
-        time.sleep(3)  # Wait for 3 seconds before searching again
+        watcher.wait(RESCAN_INTERVAL)  # Search again once a device arrives
     
 
 if __name__ == "__main__":
@@ -0,0 +1,136 @@
+"""
+Benchmark for the accessory bridge (android_accessory_v_1.py). The UART is
+emulated with a pty and the phone with an in-memory endpoint, so nothing
+here needs the real hardware.
+
+    python3 bench.py bridge
+"""
+import os
+import sys
+import time
+import argparse
+import threading
+import contextlib
+
+import serial
+
+
+class PtyUart:
+    """
+    Pseudo terminal standing in for the serial port. The bridge opens
+    self.name, the benchmark plays the device side through self.master.
+    """
+
+    def __init__(self):
+        import tty
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.slave)
+        self.name = os.ttyname(self.slave)
+
+    def read(self, size=4096):
+        return os.read(self.master, size)
+
+    def write(self, data):
+        os.write(self.master, data)
+
+    def close(self):
+        os.close(self.master)
+        os.close(self.slave)
+
+
+class RecordingEndpoint:
+    """
+    Bulk OUT endpoint that keeps what is written to it
+    """
+
+    def __init__(self):
+        self.received = bytearray()
+        self.written = threading.Event()
+
+    def write(self, data, timeout=None):
+        self.received += data
+        self.written.set()
+        return len(data)
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def cpu_usage(duration):
+    """
+    Fraction of one core the whole process uses over duration seconds
+    """
+    cpu, wall = time.process_time(), time.monotonic()
+    time.sleep(duration)
+    return (time.process_time() - cpu) / (time.monotonic() - wall)
+
+
+def bench_bridge(args):
+    """
+    Idle CPU of the bridge's UART and USB threads, and the latency of each
+    direction: USB -> queue -> uart, and uart -> queue -> USB
+    """
+    import android_accessory_v_1 as bridge
+
+    pty = PtyUart()
+    bridge.uart = serial.Serial(pty.name, baudrate=bridge.baud_rate, timeout=1)
+    bridge.running = True
+    endpoint = RecordingEndpoint()
+    for target, target_args in ((bridge.read_from_uart, ()),
+                                (bridge.send_messages_from_queue, ()),
+                                (bridge.write_to_accessory, (None, endpoint))):
+        threading.Thread(target=target, args=target_args, daemon=True).start()
+
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        time.sleep(0.2)
+        idle = cpu_usage(args.duration)
+
+        to_uart, to_usb = [], []
+        for i in range(args.count):
+            msg = b"ping %05d\n" % i
+
+            start = time.perf_counter()
+            bridge.message_queue_to_uart.put(msg)
+            received = b""
+            while len(received) < len(msg):
+                received += pty.read()
+            to_uart.append((time.perf_counter() - start) * 1e6)
+
+            endpoint.written.clear()
+            endpoint.received.clear()
+            start = time.perf_counter()
+            pty.write(msg)
+            while len(endpoint.received) < len(msg):
+                endpoint.written.wait()
+                endpoint.written.clear()
+            to_usb.append((time.perf_counter() - start) * 1e6)
+
+    bridge.running = False
+    print("idle cpu {:6.1%}".format(idle))
+    print("usb->uart p50 {:7.0f}us  p99 {:7.0f}us".format(percentile(to_uart, 50), percentile(to_uart, 99)))
+    print("uart->usb p50 {:7.0f}us  p99 {:7.0f}us".format(percentile(to_usb, 50), percentile(to_usb, 99)))
+    # The bridge threads never return, leave without joining them
+    sys.stdout.flush()
+    os._exit(0)
+
+
+BENCHMARKS = {
+    "bridge": bench_bridge,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS))
+    parser.add_argument("--count", type=int, default=1000, help="messages per direction")
+    parser.add_argument("--duration", type=float, default=2.0, help="idle measurement seconds")
+    args = parser.parse_args()
+    BENCHMARKS[args.benchmark](args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,115 @@
+"""
+Bounded FIFO of byte strings for the accessory bridge, limited by the bytes
+it holds rather than by message count. What happens when a message doesn't
+fit is up to the policy:
+
+    drop-oldest   discard the oldest messages until it fits
+    drop-newest   discard the new message
+    block         make the producer wait for room
+"""
+import queue
+import threading
+import collections
+
+DROP_OLDEST = "drop-oldest"
+DROP_NEWEST = "drop-newest"
+BLOCK = "block"
+POLICIES = (DROP_OLDEST, DROP_NEWEST, BLOCK)
+
+
+class ByteQueue:
+    """
+    Same put/get/empty/qsize calls as queue.Queue, get raises queue.Empty.
+    get_batch takes everything queued at once.
+    """
+
+    def __init__(self, max_bytes, policy=DROP_OLDEST):
+        """
+        :param max_bytes: most bytes held at once
+        :param policy: one of POLICIES
+        """
+        if policy not in POLICIES:
+            raise ValueError("Unknown queue policy: {}".format(policy))
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.items = collections.deque()
+        self.bytes = 0
+        self.cond = threading.Condition()
+        self.high_water = 0
+        self.dropped = 0
+        self.dropped_bytes = 0
+
+    def _drop(self, nbytes):
+        self.dropped += 1
+        self.dropped_bytes += nbytes
+
+    def put(self, data, timeout=None):
+        """
+        :param timeout: longest a blocked producer waits, None for no limit
+        :return: False if data was dropped
+        """
+        with self.cond:
+            if len(data) > self.max_bytes:
+                self._drop(len(data))   # never fits, whatever the policy
+                return False
+            while self.bytes + len(data) > self.max_bytes:
+                if self.policy == DROP_NEWEST:
+                    self._drop(len(data))
+                    return False
+                if self.policy == DROP_OLDEST:
+                    old = self.items.popleft()
+                    self.bytes -= len(old)
+                    self._drop(len(old))
+                elif not self.cond.wait(timeout):
+                    self._drop(len(data))
+                    return False
+            self.items.append(data)
+            self.bytes += len(data)
+            self.high_water = max(self.high_water, self.bytes)
+            self.cond.notify_all()
+            return True
+
+    def get(self, block=True, timeout=None):
+        with self.cond:
+            while not self.items:
+                if not block or not self.cond.wait(timeout):
+                    raise queue.Empty
+            data = self.items.popleft()
+            self.bytes -= len(data)
+            self.cond.notify_all()   # room for a blocked producer
+            return data
+
+    def get_batch(self, timeout=None):
+        """
+        Wait for at least one message, then take every message queued
+        :return: list of messages, oldest first
+        :raises queue.Empty: nothing arrived within timeout
+        """
+        with self.cond:
+            while not self.items:
+                if not self.cond.wait(timeout):
+                    raise queue.Empty
+            batch = list(self.items)
+            self.items.clear()
+            self.bytes = 0
+            self.cond.notify_all()
+            return batch
+
+    def empty(self):
+        with self.cond:
+            return not self.items
+
+    def qsize(self):
+        with self.cond:
+            return len(self.items)
+
+    def stats(self):
+        with self.cond:
+            return {
+                "policy": self.policy,
+                "messages": len(self.items),
+                "bytes": self.bytes,
+                "high_water": self.high_water,
+                "dropped": self.dropped,
+                "dropped_bytes": self.dropped_bytes,
+            }
@@ -0,0 +1,185 @@
+"""
+Store-and-forward spool for uart data that arrives while no accessory is
+attached.
+
+The spool is one preallocated, memory-mapped file used as an append-only
+log. Appending only dirties the pages it touches, and the kernel writes
+them back in batches, so the SD card isn't rewritten on every message. Live
+records are moved back to the front of the file (compacted) only when an
+append would run past its end. Replay hands the records back in order and
+empties the spool, peek and release do the same in two steps for callers
+that must not lose a record they failed to deliver.
+
+File layout:
+
+    header   magic, head offset, tail offset
+    records  timestamp (float64), length (uint32), payload
+"""
+import os
+import mmap
+import time
+import struct
+import logging
+
+log = logging.getLogger("spool")
+
+MAGIC = b"SPL1"
+HEADER = struct.Struct(">4sQQ")
+RECORD = struct.Struct(">dI")
+
+# Defaults: most bytes kept on disk, and how old a record may get before
+# it is no longer worth replaying
+SPOOL_MAX_BYTES = 8 * 1024 * 1024
+SPOOL_MAX_AGE = 3600
+
+
+class Spool:
+    """
+    Persistent FIFO of byte strings bounded by size and age. The oldest
+    records are dropped to make room.
+    """
+
+    def __init__(self, path, max_bytes=SPOOL_MAX_BYTES, max_age=SPOOL_MAX_AGE):
+        """
+        :param path: spool file, created if missing and reused if valid
+        :param max_bytes: file size, header included
+        :param max_age: seconds after which a record is dropped unreplayed
+        """
+        self.path = path
+        self.capacity = max_bytes
+        self.max_age = max_age
+        self.appended = 0
+        self.dropped = 0
+        self.expired = 0
+        self.compactions = 0
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if os.fstat(fd).st_size != max_bytes:
+                os.ftruncate(fd, max_bytes)
+            self.mm = mmap.mmap(fd, max_bytes)
+        finally:
+            os.close(fd)     # the mapping keeps the file open
+
+        magic, self.head, self.tail = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC or not HEADER.size <= self.head <= self.tail <= max_bytes:
+            self.head = self.tail = HEADER.size
+            self.save()
+        elif self.tail > self.head:
+            log.info("Spool {} holds {} bytes from before".format(path, self.tail - self.head))
+
+    def save(self):
+        HEADER.pack_into(self.mm, 0, MAGIC, self.head, self.tail)
+
+    def __len__(self):
+        return self.tail - self.head
+
+    def append(self, data):
+        """
+        :return: False if data can never fit and was dropped
+        """
+        size = RECORD.size + len(data)
+        if size > self.capacity - HEADER.size:
+            self.dropped += 1
+            return False
+        if self.tail + size > self.capacity:
+            self.expire()
+            if len(self) + size > self.capacity - HEADER.size:
+                # Full: make room for a quarter of the file at once, so the
+                # compaction below isn't repeated on every append
+                room = max(size, (self.capacity - HEADER.size) // 4)
+                while len(self) and len(self) + room > self.capacity - HEADER.size:
+                    self.pop()
+                    self.dropped += 1
+            self.compact()
+        RECORD.pack_into(self.mm, self.tail, time.time(), len(data))
+        self.mm[self.tail + RECORD.size:self.tail + size] = data
+        self.tail += size
+        self.save()
+        self.appended += 1
+        return True
+
+    def pop(self):
+        """
+        Remove the oldest record
+        :return: its timestamp and payload
+        """
+        stamp, length = RECORD.unpack_from(self.mm, self.head)
+        start = self.head + RECORD.size
+        data = self.mm[start:start + length]
+        self.head = start + length
+        if self.head == self.tail:
+            self.head = self.tail = HEADER.size
+        self.save()
+        return stamp, data
+
+    def expire(self):
+        """
+        Drop records older than max_age from the front
+        """
+        cutoff = time.time() - self.max_age
+        while len(self) and RECORD.unpack_from(self.mm, self.head)[0] < cutoff:
+            self.pop()
+            self.expired += 1
+
+    def compact(self):
+        """
+        Move the live records to the front of the file
+        """
+        if self.head == HEADER.size:
+            return
+        live = len(self)
+        if live:
+            self.mm.move(HEADER.size, self.head, live)
+        self.head = HEADER.size
+        self.tail = HEADER.size + live
+        self.save()
+        self.compactions += 1
+
+    def replay(self):
+        """
+        Yield the spooled payloads oldest first, removing each one as it is
+        handed out. Expired records are skipped.
+        """
+        self.expire()
+        while len(self):
+            yield self.pop()[1]
+
+    def peek(self):
+        """
+        Yield the spooled payloads oldest first without removing them, each
+        with the offset to hand release() once it has been delivered.
+        Expired records are skipped. Nothing may be appended meanwhile.
+        """
+        self.expire()
+        offset = self.head
+        while offset < self.tail:
+            _, length = RECORD.unpack_from(self.mm, offset)
+            start = offset + RECORD.size
+            offset = start + length
+            yield offset, self.mm[start:offset]
+
+    def release(self, end):
+        """
+        Remove the records before end, an offset from peek()
+        """
+        self.head = end
+        if self.head == self.tail:
+            self.head = self.tail = HEADER.size
+        self.save()
+
+    def flush(self):
+        self.mm.flush()
+
+    def close(self):
+        self.mm.flush()
+        self.mm.close()
+
+    def stats(self):
+        return {
+            "bytes": len(self),
+            "appended": self.appended,
+            "dropped": self.dropped,
+            "expired": self.expired,
+            "compactions": self.compactions,
+        }
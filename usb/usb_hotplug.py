@@ -0,0 +1,157 @@
+"""
+Wake up as soon as a USB device is plugged in or re-enumerates, instead of
+sleeping for a fixed time and scanning the bus again.
+
+DeviceWatcher uses, in order of preference:
+
+    libusb    hotplug callbacks on pyusb's libusb1 backend context
+    netlink   kernel uevents (what udev itself listens to), Linux only
+    poll      nothing to listen to, wait() just sleeps
+"""
+import time
+import ctypes
+import select
+import socket
+import logging
+
+import usb.backend.libusb1 as libusb1
+
+log = logging.getLogger("usb_hotplug")
+
+LIBUSB_CAP_HAS_HOTPLUG = 0x0101
+LIBUSB_HOTPLUG_EVENT_DEVICE_ARRIVED = 0x01
+LIBUSB_HOTPLUG_MATCH_ANY = -1
+
+NETLINK_KOBJECT_UEVENT = 15
+UEVENT_GROUP_KERNEL = 1
+UEVENT_BUFFER_SIZE = 16384
+
+_hotplug_callback_fn = ctypes.CFUNCTYPE(ctypes.c_int, ctypes.c_void_p, ctypes.c_void_p,
+                                        ctypes.c_int, ctypes.c_void_p)
+
+
+class _timeval(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long),
+                ('tv_usec', ctypes.c_long)]
+
+
+class DeviceWatcher:
+    """
+    Reports USB device arrivals. Arrivals seen between two wait() calls are
+    remembered, so a device plugged in during a scan is not missed.
+    """
+
+    def __init__(self, vendor_id=None):
+        """
+        :param vendor_id: only report devices with this idVendor, None for all
+        """
+        self.vendor_id = vendor_id
+        self.arrived = False
+        self.mode = "poll"
+        self.backend = None
+        self.handle = None
+        self.callback = None
+        self.skt = None
+
+        if self._start_libusb():
+            self.mode = "libusb"
+        elif self._start_netlink():
+            self.mode = "netlink"
+        log.info("Watching for USB devices with {}".format(self.mode))
+
+    @property
+    def events(self):
+        """
+        True when wait() returns early on arrivals, False when it only sleeps
+        """
+        return self.mode != "poll"
+
+    def _start_libusb(self):
+        backend = libusb1.get_backend()
+        if backend is None:
+            return False
+        lib = backend.lib
+        try:
+            if not lib.libusb_has_capability(LIBUSB_CAP_HAS_HOTPLUG):
+                return False
+            lib.libusb_hotplug_register_callback.argtypes = [
+                ctypes.c_void_p, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_int,
+                ctypes.c_int, _hotplug_callback_fn, ctypes.c_void_p, ctypes.POINTER(ctypes.c_int)]
+            lib.libusb_hotplug_deregister_callback.argtypes = [ctypes.c_void_p, ctypes.c_int]
+            lib.libusb_handle_events_timeout.argtypes = [ctypes.c_void_p, ctypes.POINTER(_timeval)]
+        except AttributeError:
+            return False    # libusb older than 1.0.16
+
+        # Must outlive the registration, libusb only keeps the pointer
+        self.callback = _hotplug_callback_fn(self._on_hotplug)
+        handle = ctypes.c_int()
+        vendor = LIBUSB_HOTPLUG_MATCH_ANY if self.vendor_id is None else self.vendor_id
+        ret = lib.libusb_hotplug_register_callback(
+            backend.ctx, LIBUSB_HOTPLUG_EVENT_DEVICE_ARRIVED, 0, vendor,
+            LIBUSB_HOTPLUG_MATCH_ANY, LIBUSB_HOTPLUG_MATCH_ANY, self.callback, None,
+            ctypes.byref(handle))
+        if ret != 0:
+            log.warning("libusb hotplug registration failed: {}".format(ret))
+            return False
+        self.backend = backend
+        self.handle = handle.value
+        return True
+
+    def _on_hotplug(self, ctx, device, event, user_data):
+        self.arrived = True
+        return 0    # stay registered
+
+    def _start_netlink(self):
+        try:
+            skt = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+            skt.bind((0, UEVENT_GROUP_KERNEL))
+        except (AttributeError, OSError) as e:
+            log.warning("Kernel uevents unavailable: {}".format(e))
+            return False
+        self.skt = skt
+        return True
+
+    def _read_uevents(self):
+        """
+        Consume queued uevents, flag an arrival if one is a USB device being added
+        """
+        while True:
+            try:
+                msg = self.skt.recv(UEVENT_BUFFER_SIZE, socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                return
+            fields = dict(f.split(b"=", 1) for f in msg.split(b"\x00") if b"=" in f)
+            if (fields.get(b"ACTION") == b"add" and fields.get(b"SUBSYSTEM") == b"usb"
+                    and fields.get(b"DEVTYPE") == b"usb_device"):
+                if self.vendor_id is None or fields.get(b"PRODUCT", b"").split(b"/")[0] == \
+                        "{:x}".format(self.vendor_id).encode():
+                    self.arrived = True
+
+    def wait(self, timeout):
+        """
+        Block until a device arrives or timeout seconds pass
+        :return: True if a device arrived
+        """
+        deadline = time.monotonic() + timeout
+        while not self.arrived:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            if self.mode == "libusb":
+                tv = _timeval(int(remaining), int(remaining % 1 * 1e6))
+                self.backend.lib.libusb_handle_events_timeout(self.backend.ctx, ctypes.byref(tv))
+            elif self.mode == "netlink":
+                if select.select([self.skt], [], [], remaining)[0]:
+                    self._read_uevents()
+            else:
+                time.sleep(remaining)
+        arrived, self.arrived = self.arrived, False
+        return arrived
+
+    def close(self):
+        if self.handle is not None:
+            self.backend.lib.libusb_hotplug_deregister_callback(self.backend.ctx, self.handle)
+            self.handle = None
+        if self.skt is not None:
+            self.skt.close()
+            self.skt = None
@@ -1,9 +1,22 @@
+import os
 import zmq
+import errno
 import time
+import array
 import logging
+import collections
 import usb.core
 import usb.util
 import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FuturesTimeout
+
+import usb_async
+import endpoints
+import usb_hotplug
+from spool import Spool
+from usb_framing import MessageDecoder, encode_message
+from uart import CoalescingWriter
+from credit import CreditGranter
 
 
 #  Product IDs / Vendor IDs
@@ -18,44 +31,221 @@ AOA_ACCESSORY_AUDIO_ADB_PRODUCT_ID  = 0x2D05  # accessory + audio + adb
 GOOGLE_VID = 0x18D1
 ACCESSORY_PIDS = {0x2D00, 0x2D01}  # Accessory mode product IDs
 
-logging.basicConfig(level=logging.DEBUG)
+USB_READ_DEPTH = usb_async.ASYNC_DEPTH  # Bulk IN transfers kept in flight, 0 = one synchronous read at a time
+USB_READ_SIZE = 16384                   # Synchronous bulk IN read size, rounded down to whole packets
+USB_FRAMED = False                      # Length-prefixed messages over USB (usb_framing), the app must match
+STATS_INTERVAL = 10                     # Seconds between throughput reports
+WRITE_POLL_TIMEOUT = 500                # ms the writer blocks before checking for shutdown
+WRITE_BATCH = 64                        # Most ZMQ messages taken off the socket per wakeup
+USB_WRITE_SIZE = 16384                  # Largest bulk OUT write, rounded down to whole packets
+USB_WRITE_DELAY = 0.002                 # Seconds a message may wait for more to share its write
+RESCAN_INTERVAL = 3                     # Seconds between bus scans when no device arrives
+ACCESSORY_SWITCH_TIMEOUT = 2            # Seconds a phone gets to re-enumerate in accessory mode
+ACCESSORY_POLL_INTERVAL = 0.1           # Seconds between looks for it when hotplug is unavailable
+PROBE_CACHE_TTL = 300                   # Seconds a device that refused accessory mode is skipped
+REATTACH_TIMEOUT = 300                  # Seconds a session's threads wait for its accessory to come back
+SPOOL_DIR = None                        # Directory for the spool of uart data, None = no spooling
+SESSIONS_ADDR = "inproc://usb-sessions" # UartDispatcher publisher, one topic per session
+HANDSHAKE_WORKERS = 4                   # Devices taken through the AOA handshake at once
+HANDSHAKE_DEADLINE = 3                  # Seconds the handshakes of one scan may take in total
+AOA_TRANSFER_TIMEOUT = 500              # ms one AOA control transfer may take
+
+logging.basicConfig(level=logging.INFO)  # DEBUG logs every message, slow at full USB speed
 log = logging.getLogger("usb_host")
 
-context = zmq.Context()
+context = zmq.Context.instance()   # shared with the other bridges in hub.py
+
+
+class RateMeter:
+    """
+    Logs the sustained rate of a byte stream every interval seconds
+    """
+    def __init__(self, name, interval=STATS_INTERVAL):
+        self.name = name
+        self.interval = interval
+        self.bytes = 0
+        self.start = time.monotonic()
+
+    def add(self, nbytes):
+        self.bytes += nbytes
+        now = time.monotonic()
+        elapsed = now - self.start
+        if elapsed >= self.interval:
+            log.info("{} {:.3f} MB/s".format(self.name, self.bytes / elapsed / 1e6))
+            self.bytes = 0
+            self.start = now
+
+
+class BulkWriter(CoalescingWriter):
+    """
+    CoalescingWriter for a bulk OUT endpoint. Once max_bytes are pending
+    exactly max_bytes go out, the remainder stays pending with the deadline
+    of its oldest message, so only the last write of a burst ends in a short
+    packet. A write ending on a full packet with nothing left behind it is
+    followed by a zero length packet, the phone's read only completes on a
+    short one.
+
+    write gets the data and the payload bytes of the messages it completes,
+    the bytes they had before usb_framing, for the credit granted back.
+    """
+
+    def __init__(self, write, max_packet, max_bytes=USB_WRITE_SIZE, max_delay=USB_WRITE_DELAY):
+        """
+        :param max_packet: wMaxPacketSize of the endpoint
+        :param max_bytes: rounded down to whole packets
+        """
+        super().__init__(write, max(max_packet, max_bytes // max_packet * max_packet), max_delay)
+        self.max_packet = max_packet
+        self.sizes = collections.deque()   # [bytes not yet written, payload] per pending message
+        self.zero_length_packets = 0
+
+    def add(self, data, payload=None):
+        """
+        :param payload: bytes the message stands for, len(data) when None
+        """
+        if not self.pending:
+            self.deadline = time.monotonic() + self.max_delay
+        self.pending.append(data)
+        self.pending_bytes += len(data)
+        self.sizes.append([len(data), len(data) if payload is None else payload])
+        while self.pending_bytes >= self.max_bytes:
+            self.flush(whole_packets=True)
+
+    def flush(self, whole_packets=False):
+        """
+        :param whole_packets: write at most max_bytes, in whole packets, and
+                              keep the rest pending
+        """
+        if not self.pending:
+            return
+        data = self.pending[0] if len(self.pending) == 1 else b"".join(self.pending)
+        size = len(data)
+        if whole_packets:
+            size = min(size, self.max_bytes)
+            size -= size % self.max_packet
+        if not size:
+            return
+        if size < len(data):
+            self.pending = [data[size:]]
+            self.pending_bytes = len(data) - size
+            data = data[:size]
+        else:
+            self.pending = []
+            self.pending_bytes = 0
+            self.deadline = None
+
+        count = payload = 0
+        left = size
+        while self.sizes and self.sizes[0][0] <= left:
+            nbytes, message_payload = self.sizes.popleft()
+            left -= nbytes
+            payload += message_payload
+            count += 1
+        if left:
+            self.sizes[0][0] -= left
+
+        self.write(data, payload)
+        if not self.pending and size % self.max_packet == 0:
+            self.write(b"", 0)
+            self.zero_length_packets += 1
+        self.writes += 1
+        self.messages += count
+        self.messages_per_write[count] += 1
+
+    def stats(self):
+        stats = super().stats()
+        stats["zero_length_packets"] = self.zero_length_packets
+        return stats
+
 
-# Client code that connects to the UartServer publisher (receives from the uart)
-in_sock = context.socket(zmq.SUB)
-in_sock.connect("tcp://localhost:5556")
-in_sock.setsockopt_string(zmq.SUBSCRIBE, "")
+def device_identity(dev):
+    """
+    Name of the port a device is plugged into, in sysfs style (e.g. 1-1.2).
+    It survives the re-enumeration into accessory mode, unlike the address.
+    """
+    ports = dev.port_numbers or (dev.address,)
+    return "{}-{}".format(dev.bus, ".".join(str(port) for port in ports))
 
-# Server Code that connects to the UartServers subscriber (sends to the uart)
-out_sock = context.socket(zmq.PUB)
-out_sock.connect("tcp://localhost:5555")
+
+class ProbeCache:
+    """
+    Remembers devices that refused accessory mode so scans can skip them.
+    Only real refusals go in: a handshake that timed out or hit the
+    deadline says nothing about the device.
+    Entries expire after ttl seconds or once the device leaves the bus. A
+    re-plugged device gets a new address, and with it a new key.
+    """
+    def __init__(self, ttl=PROBE_CACHE_TTL):
+        self.ttl = ttl
+        self.refused = {}
+
+    @staticmethod
+    def key(dev):
+        # The address stands in for the serial number, reading that would
+        # cost a control transfer per device per scan
+        return dev.bus, tuple(dev.port_numbers or ()), dev.address, dev.idVendor, dev.idProduct
+
+    def add(self, dev):
+        self.refused[self.key(dev)] = time.monotonic()
+
+    def skip(self, dev):
+        since = self.refused.get(self.key(dev))
+        return since is not None and time.monotonic() - since < self.ttl
+
+    def prune(self, devices):
+        """
+        Forget expired entries and devices that are no longer on the bus
+        """
+        present = {self.key(dev) for dev in devices}
+        now = time.monotonic()
+        self.refused = {key: since for key, since in self.refused.items()
+                        if key in present and now - since < self.ttl}
 
 
 class Android:
-    device = None
 
-    def send_string(self, index, string):
+    def __init__(self, watcher=None):
+        self.watcher = watcher or usb_hotplug.DeviceWatcher()
+        self.probe_cache = ProbeCache()
+
+    @staticmethod
+    def transfer_timeout(deadline):
+        """
+        :return: ms the next control transfer may take, at most
+                 AOA_TRANSFER_TIMEOUT and never past the deadline
+        """
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError("accessory handshake deadline passed")
+        return max(1, min(AOA_TRANSFER_TIMEOUT, int(remaining * 1000)))
+
+    def send_string(self, dev, index, string, deadline):
         """
+        :param dev:
         :param index:
         :param string:
+        :param deadline:
         :return:
         """
-        sent = self.device.ctrl_transfer(
+        sent = dev.ctrl_transfer(
                                 bmRequestType=usb.util.CTRL_OUT | usb.util.CTRL_TYPE_VENDOR,
                                 bRequest=52,
                                 wValue=0,
                                 wIndex=index,
-                                data_or_wLength=string.encode('utf-8') + b'\x00')
+                                data_or_wLength=string.encode('utf-8') + b'\x00',
+                                timeout=self.transfer_timeout(deadline))
 
         return True if sent == len(string) + 1 else False
 
-    def send_accessory_mode_commands(self):
+    def send_accessory_mode_commands(self, dev, deadline):
         """
         Assuming standard Android accessory mode protocol
         These strings should be replaced with your specific values
-        :return:
+        :param dev:
+        :param deadline: time.monotonic() by which the whole handshake must be done
+        :return: True once the device was told to switch, False if it refused
+                 (protocol 0 or a STALL on the protocol request), None if
+                 that isn't known (deadline passed, timeout, transfer error)
         """
         manufacturer = 'TEST MANUFACTURER'
         model = 'TEST MODEL'
@@ -66,12 +256,19 @@ class Android:
 
         try:
             # Step 1: Get Protocol
-            protocol = self.device.ctrl_transfer( bmRequestType=usb.util.CTRL_IN | usb.util.CTRL_TYPE_VENDOR,
-                                                    bRequest=51,
-                                                    wValue=0,
-                                                    wIndex=0,
-                                                    data_or_wLength=2
-                                                )
+            try:
+                protocol = dev.ctrl_transfer( bmRequestType=usb.util.CTRL_IN | usb.util.CTRL_TYPE_VENDOR,
+                                                bRequest=51,
+                                                wValue=0,
+                                                wIndex=0,
+                                                data_or_wLength=2,
+                                                timeout=self.transfer_timeout(deadline)
+                                            )
+            except usb.core.USBError as e:
+                if e.errno != errno.EPIPE:
+                    raise
+                log.info("{:04x}:{:04x} stalled the protocol request".format(dev.idVendor, dev.idProduct))
+                return False
 
             # Check protocol support
             protocol_version = int.from_bytes(protocol, byteorder='little')
@@ -79,77 +276,140 @@ class Android:
                 log.info('Accessory mode not supported')
                 return False
 
+            # Only AOA devices get this far, and get_string has no timeout
+            # argument, it uses the device default
+            dev.default_timeout = self.transfer_timeout(deadline)
+            log.info("checking device: {}".format(usb.util.get_string(dev, dev.iProduct)))
+
             # Step 2: Send identifying strings
-            self.send_string( 0, manufacturer)
-            self.send_string( 1, model)
-            self.send_string( 2, description)
-            self.send_string( 3, version)
-            self.send_string( 4, uri)
-            self.send_string( 5, serial)
+            self.send_string(dev, 0, manufacturer, deadline)
+            self.send_string(dev, 1, model, deadline)
+            self.send_string(dev, 2, description, deadline)
+            self.send_string(dev, 3, version, deadline)
+            self.send_string(dev, 4, uri, deadline)
+            self.send_string(dev, 5, serial, deadline)
 
             # Step 3: Start accessory mode
-            self.device.ctrl_transfer(
+            dev.ctrl_transfer(
                 bmRequestType=usb.util.CTRL_OUT | usb.util.CTRL_TYPE_VENDOR,
                 bRequest=53,
                 wValue=0,
                 wIndex=0,
-                data_or_wLength=None
+                data_or_wLength=None,
+                timeout=self.transfer_timeout(deadline)
             )
             log.info("Switched to accessory mode")
             return True
+        except (TimeoutError, usb.core.USBError) as e:
+            log.info("Handshake with {:04x}:{:04x} unfinished: {}".format(dev.idVendor, dev.idProduct, e))
+            return None
         except Exception as e:
             log.error("Failed to send accessory mode commands:{}".format(e))
-            return False
+            return None
 
-    def attempt_accessory_mode_for_device(self):
-        try:
-            # Send accessory mode commands and check if successful
-            if self.send_accessory_mode_commands():
-                # Wait for the device to disconnect and reconnect
-                log.info("Waiting for device to switch to accessory mode...")
-                time.sleep(1)
-                accessory = self.find_accessory_device()
-                if accessory is not None:
-                    log.info("Device found in accessory mode: {}".format(accessory))
-                    return accessory  # Return the device if accessory mode command was successful
-                else:
-                    log.info("Device not found in accessory mode.")
-                    return None
+    def probe_device(self, dev, deadline):
+        """
+        Ask one device to switch to accessory mode, runs on the handshake pool
+        :return: True if the device accepted
+        """
+        start = time.monotonic()
+        accepted = self.send_accessory_mode_commands(dev, deadline)
+        if accepted:
+            log.info("{:04x}:{:04x} accepted accessory mode after {:.0f} ms".format(
+                dev.idVendor, dev.idProduct, (time.monotonic() - start) * 1000))
+            return True
+        if accepted is False:
+            self.probe_cache.add(dev)
+        return False
 
+    def attempt_accessory_mode(self, candidates, start, exclude=()):
+        """
+        Run the handshake on every candidate at once, so a slow or stuck
+        device only holds up its own worker
+        :param candidates: devices to probe
+        :param start: time.monotonic() the scan started, time to accessory
+                      mode is measured from it
+        :param exclude: identities of accessories that already have a session
+        :return: the first device that comes back in accessory mode, or None
+        """
+        deadline = start + HANDSHAKE_DEADLINE
+        pool = ThreadPoolExecutor(max_workers=HANDSHAKE_WORKERS)
+        futures = [pool.submit(self.probe_device, dev, deadline) for dev in candidates]
+        try:
+            for future in as_completed(futures, timeout=max(0, deadline - time.monotonic())):
+                if future.result():
+                    break
             else:
                 return None
-        except Exception as e:
-            log.error("Error attempting accessory mode:{}".format(e))
+        except FuturesTimeout:
+            log.info("Accessory handshake deadline passed")
+            return None
+        finally:
+            # Candidates still queued behind the workers are never started,
+            # running ones give up by the deadline on their own
+            pool.shutdown(wait=False, cancel_futures=True)
+
+        switched = time.monotonic()
+        # Wait for the device to disconnect and reconnect
+        log.info("Waiting for device to switch to accessory mode...")
+        accessory = self.wait_for_accessory_device(exclude=exclude)
+        if accessory is None:
+            log.info("Device not found in accessory mode.")
             return None
+        found = time.monotonic()
+        log.info("Device found in accessory mode: {}".format(accessory))
+        log.info("Time to accessory mode {:.0f} ms (handshake {:.0f} ms, re-enumeration {:.0f} ms)".format(
+            (found - start) * 1000, (switched - start) * 1000, (found - switched) * 1000))
+        return accessory
 
-    def identify_android_device_as_usb(self):
+    def identify_android_device_as_usb(self, exclude=()):
+        """
+        :param exclude: identities of accessories that already have a session,
+                        they are neither returned nor probed
+        :return: an accessory without a session, or None
+        """
         try:
-            already_in_OAM_device = self.find_accessory_device()
+            already_in_OAM_device = self.find_accessory_device(exclude)
             if already_in_OAM_device is not None:
                 return already_in_OAM_device
+            start = time.monotonic()
             devices = list(usb.core.find(find_all=True))
+            self.probe_cache.prune(devices)
 
-            # Iterate over all connected USB devices
-            for dev in devices:
-                self.device = dev
-                description = usb.util.get_string(dev, dev.iProduct)
-                log.info("checking device: {}".format(description))
-                accessory_dev = self.attempt_accessory_mode_for_device()
-                if accessory_dev is not None:
-                    return accessory_dev  # Return the device already in accessory mode
-            return None
+            # Probe all connected USB devices, except known non-accessories
+            candidates = [dev for dev in devices
+                          if not self.probe_cache.skip(dev) and device_identity(dev) not in exclude]
+            accessory_dev = self.attempt_accessory_mode(candidates, start, exclude) if candidates else None
+            log.info("Scan took {:.1f} ms, probed {} of {} devices".format(
+                (time.monotonic() - start) * 1000, len(candidates), len(devices)))
+            return accessory_dev  # The device now in accessory mode, if any
         except usb.core.USBError as e:
             return None
         except Exception as e:
             log.error("Error attempting accessory mode:{}".format(e))
             return None
 
+    def wait_for_accessory_device(self, timeout=ACCESSORY_SWITCH_TIMEOUT, exclude=()):
+        """
+        Look for the accessory each time a device arrives, until timeout
+        :return: the accessory device or None
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            self.watcher.wait(remaining if self.watcher.events else ACCESSORY_POLL_INTERVAL)
+            accessory = self.find_accessory_device(exclude)
+            if accessory is not None:
+                return accessory
+
     @staticmethod
-    def find_accessory_device():
+    def find_accessory_device(exclude=()):
         try:
             dev = usb.core.find(idVendor=GOOGLE_VID, find_all=True)
             for d in dev:
-                if d.idProduct in ACCESSORY_PIDS:
+                if d.idProduct in ACCESSORY_PIDS and device_identity(d) not in exclude:
                     return d
             return None
         except usb.core.USBError as e:
@@ -173,110 +433,598 @@ class Android:
 
         return ep_in, ep_out
 
-    @staticmethod
-    def read_from_accessory(endpoint_in):
+
+class EndpointRef:
+    """
+    Bulk endpoint known only by its address, lets a returning accessory skip
+    the descriptor lookup
+    """
+
+    def __init__(self, device, address, max_packet):
+        self.device = device
+        self.bEndpointAddress = address
+        self.wMaxPacketSize = max_packet
+
+    def read(self, size_or_buffer, timeout=None):
+        return self.device.read(self.bEndpointAddress, size_or_buffer, timeout)
+
+    def write(self, data, timeout=None):
+        return self.device.write(self.bEndpointAddress, data, timeout)
+
+
+def session_topic(identity):
+    # The separator keeps "1-1" from matching the topic of "1-1.2"
+    return identity.encode() + b"/"
+
+
+class UartDispatcher:
+    """
+    The sessions' one subscription to the uart. Each message goes to the
+    sessions that have an accessory attached, with their identity as the
+    topic, or into the spool when none has. A message in an envelope,
+    [topic, data], only goes to that session, and is dropped when it has
+    no accessory attached: the spool goes to whichever phone comes next.
+    It lives as long as the process, so with a spool nothing the uart
+    sends is lost between phones: not before the first one, nor after a
+    session is reaped.
+    """
+
+    def __init__(self, spool=None):
+        self.spool = spool
+        self.lock = threading.Lock()    # held to route, spool and replay
+        self.routes = set()             # topics of the sessions taking data
+        self.dropped = 0                # messages nobody took, without a spool or addressed
+        self.dropped_bytes = 0
+        self.dropping = False
+        self.overflowing = False
+        self.missing = set()            # topics warned about addressed data dropped
+        self.running = False
+        self.thread = None
+        self.in_sock = context.socket(zmq.SUB)
+        self.in_sock.setsockopt(zmq.LINGER, 0)
+        self.in_sock.connect(endpoints.connect_addr(endpoints.FROM_UART))
+        self.in_sock.setsockopt_string(zmq.SUBSCRIBE, "")
+        # XPUB_NODROP: a session too slow to keep up makes send() fail, so
+        # the drop is counted instead of lost at the high-water mark
+        self.out_sock = context.socket(zmq.XPUB)
+        self.out_sock.setsockopt(zmq.LINGER, 0)
+        self.out_sock.setsockopt(zmq.XPUB_NODROP, 1)
+        self.out_sock.bind(SESSIONS_ADDR)
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="usb-uart")
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+        self.in_sock.close()
+        self.out_sock.close()
+        if self.spool is not None:
+            self.spool.close()
+
+    def run(self):
+        poller = zmq.Poller()
+        poller.register(self.in_sock, zmq.POLLIN)
+        poller.register(self.out_sock, zmq.POLLIN)
+        while self.running:
+            if not poller.poll(WRITE_POLL_TIMEOUT):
+                continue
+            # The sessions' (un)subscriptions, routes decide who gets what
+            while self.out_sock.getsockopt(zmq.EVENTS) & zmq.POLLIN:
+                self.out_sock.recv()
+            while self.in_sock.getsockopt(zmq.EVENTS) & zmq.POLLIN:
+                frames = self.in_sock.recv_multipart()
+                data = frames[-1]
+                with self.lock:
+                    if len(frames) > 1:
+                        # Sessions see the envelope too, so close_route()
+                        # never spools it for another phone
+                        if frames[0] in self.routes:
+                            self.send([frames[0], frames[0], data])
+                        else:
+                            if frames[0] not in self.missing:
+                                log.warning("No accessory {} attached, dropping data addressed to it".format(
+                                    frames[0][:-1].decode(errors='replace')))
+                                self.missing.add(frames[0])
+                            self.dropped += 1
+                            self.dropped_bytes += len(data)
+                    elif self.routes:
+                        self.dropping = False
+                        for topic in self.routes:
+                            self.send([topic, data])
+                    elif self.spool is not None:
+                        self.spool.append(data)
+                    else:
+                        if not self.dropping:
+                            log.warning("No accessory attached, dropping uart data until one is")
+                            self.dropping = True
+                        self.dropped += 1
+                        self.dropped_bytes += len(data)
+
+    def send(self, frames):
+        try:
+            self.out_sock.send_multipart(frames, flags=zmq.NOBLOCK)
+            self.overflowing = False
+        except zmq.Again:
+            if not self.overflowing:
+                log.warning("USB {} isn't keeping up, dropping uart data".format(
+                    frames[0][:-1].decode(errors='replace')))
+                self.overflowing = True
+            self.dropped += 1
+            self.dropped_bytes += len(frames[-1])
+
+    def open_route(self, identity, replay=None):
+        """
+        Start handing a session the uart data
+        :param replay: called with the spool first, if there is one. Nothing
+                       is routed or spooled meanwhile, so the live data
+                       follows what was spooled.
+        """
+        with self.lock:
+            if replay is not None and self.spool is not None:
+                replay(self.spool)
+            self.routes.add(session_topic(identity))
+            self.missing.discard(session_topic(identity))
+
+    def close_route(self, identity, sock):
+        """
+        Stop handing a session data. What it was handed but didn't write
+        goes back into the spool when no other session takes data, unless
+        it was addressed to this one.
+        :param sock: the session's SUB socket
+        :return: messages and bytes dropped
+        """
+        dropped = dropped_bytes = 0
+        with self.lock:
+            self.routes.discard(session_topic(identity))
+            while sock.getsockopt(zmq.EVENTS) & zmq.POLLIN:
+                frames = sock.recv_multipart()
+                data = frames[-1]
+                if self.spool is not None and not self.routes and len(frames) == 2:
+                    self.spool.append(data)
+                else:
+                    dropped += 1
+                    dropped_bytes += len(data)
+        return dropped, dropped_bytes
+
+    def stats(self):
+        with self.lock:
+            return {
+                "routes": len(self.routes),
+                "dropped": self.dropped,
+                "dropped_bytes": self.dropped_bytes,
+                "spool": self.spool.stats() if self.spool is not None else None,
+            }
+
+
+class AccessorySession:
+    """
+    The accessory on one port: its endpoints, reader and writer threads and
+    ZMQ sockets. Sessions share nothing but the zmq context, so several
+    phones run side by side and one going away doesn't stop the others.
+
+    The threads outlive the accessory. When it goes away they park until
+    the same port gets an accessory again, which is then attached without
+    starting anything new.
+
+    The uart is a single byte stream, so everything read from it goes to
+    every attached session, through the UartDispatcher. The identity is the
+    session's topic there, and the envelope of everything it sends towards
+    the uart, so replies can be routed back to the phone they are for. It
+    also tags the session's logs, throughput and credit consumer, so the
+    hub's flow control tracks every phone on its own.
+    """
+
+    def __init__(self, identity, dispatcher):
+        self.identity = identity
+        self.topic = session_topic(identity)
+        self.dispatcher = dispatcher
+        self.endpoint_in = None
+        self.endpoint_out = None
+        self.running = False        # the threads are alive
+        self.connected = False      # an accessory is attached
+        self.busy = 0               # threads still working on the current attachment
+        self.state = threading.Condition()
+        self.threads = []
+        self.attachments = 0
+        self.attached_at = None     # set from attach until the first byte
+        self.detached_at = None
+        self.first_byte_ms = None
+        self.decoder = None
+
+        # Created here rather than in the threads so the subscriptions are on
+        # their way before the first bytes flow
+        self.in_sock = context.socket(zmq.SUB)
+        self.in_sock.setsockopt(zmq.LINGER, 0)
+        self.in_sock.connect(SESSIONS_ADDR)
+        self.in_sock.setsockopt(zmq.SUBSCRIBE, self.topic)
+        self.out_sock = context.socket(zmq.PUB)
+        self.out_sock.setsockopt(zmq.LINGER, 0)
+        self.out_sock.connect(endpoints.connect_addr(endpoints.TO_UART))
+
+    def start(self):
+        self.running = True
+        self.threads = [threading.Thread(target=self.read_from_accessory, name="usb-in-" + self.identity),
+                        threading.Thread(target=self.write_to_accessory, name="usb-out-" + self.identity)]
+        for thread in self.threads:
+            thread.start()
+        log.info("Session {} started".format(self.identity))
+
+    def stop(self):
+        with self.state:
+            self.running = False
+            self.connected = False
+            self.state.notify_all()
+        for thread in self.threads:
+            thread.join()
+        log.info("Session {} ended".format(self.identity))
+
+    def attach(self, endpoint_in, endpoint_out):
+        """
+        Hand the threads an accessory, only while idle()
+        """
+        with self.state:
+            self.endpoint_in = endpoint_in
+            self.endpoint_out = endpoint_out
+            self.attachments += 1
+            self.decoder = MessageDecoder() if USB_FRAMED else None  # every attachment starts a new stream
+            self.attached_at = time.monotonic()
+            self.connected = True
+            self.state.notify_all()
+        log.info("Session {} attached ({} so far)".format(self.identity, self.attachments))
+
+    def detach(self):
+        """
+        The accessory is gone, both threads drop it and park
+        """
+        with self.state:
+            if self.connected:
+                self.connected = False
+                self.detached_at = time.monotonic()
+                self.state.notify_all()
+
+    def idle(self):
+        """
+        :return: True when detached and both threads are parked
+        """
+        with self.state:
+            return not self.connected and self.busy == 0
+
+    def wait_attached(self, timeout=None):
+        """
+        Park the calling thread until an accessory is attached
+        :param timeout: longest wait in seconds, None for no limit
+        :return: True once attached, False on timeout or once the session is stopped
+        """
+        with self.state:
+            self.state.wait_for(lambda: not self.running or self.connected, timeout)
+            if self.running and self.connected:
+                self.busy += 1
+                return True
+            return False
+
+    def attachment_done(self):
+        self.detach()   # whatever ended one thread's transfers ends the attachment
+        with self.state:
+            self.busy -= 1
+
+    def first_byte(self):
+        """
+        Record how long the current attachment took to move its first byte
+        """
+        with self.state:
+            if self.attached_at is None:
+                return
+            self.first_byte_ms = (time.monotonic() - self.attached_at) * 1000
+            self.attached_at = None
+        log.info("Session {} attach to first byte: {:.1f} ms".format(self.identity, self.first_byte_ms))
+
+    def stats(self):
+        return {
+            "attachments": self.attachments,
+            "first_byte_ms": self.first_byte_ms,
+            "framing": self.decoder.stats() if self.decoder is not None else None,
+        }
+
+    def read_from_accessory(self):
         """
-        Get data from the Android
-        :param endpoint_in:
+        Get data from the Android, keeping USB_READ_DEPTH transfers in flight
+        when the libusb1 backend allows it
         :return:
         """
-        global running
-        while running:
+        meter = RateMeter("USB IN {}".format(self.identity))
+        while self.wait_attached():
+            if USB_READ_DEPTH and usb_async.supported(self.endpoint_in.device):
+                self.read_from_accessory_async(meter)
+            else:
+                self.read_from_accessory_sync(meter)
+            self.attachment_done()
+        self.out_sock.close()
+
+    def publish(self, data):
+        """
+        Send what a bulk read returned towards the uart. With USB_FRAMED that
+        is one ZMQ message per complete application message, however the
+        reads split them.
+        """
+        if self.decoder is None:
+            self.out_sock.send(self.topic, zmq.SNDMORE)
+            self.out_sock.send(data)
+        else:
+            for message in self.decoder.feed(data):
+                self.out_sock.send(self.topic, zmq.SNDMORE)
+                self.out_sock.send(message, copy=False)
+
+    def read_from_accessory_async(self, meter):
+
+        def deliver(data):
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("Received data from USB {}:{}".format(
+                    self.identity, data.tobytes().decode('utf-8', errors='replace')))
+            if self.attached_at is not None:
+                self.first_byte()
+            self.publish(data)
+            meter.add(len(data))
+
+        try:
+            reader = usb_async.AsyncBulkReader(self.endpoint_in.device, self.endpoint_in, depth=USB_READ_DEPTH)
+            reader.run(deliver, lambda: self.connected)
+        except usb.core.USBError as e:
+            log.error("Read thread USB error {}:{}".format(self.identity, e))
+            self.detach()  # Stop the threads
+        except Exception as e:
+            log.error("Read thread unexpected error {}:{}".format(self.identity, e))
+            self.detach()  # Stop the threads
+
+    def read_from_accessory_sync(self, meter):
+        # Read into the same buffer every time, send() copies straight out of
+        # it into the ZMQ message
+        max_packet = self.endpoint_in.wMaxPacketSize
+        buf = array.array('B', bytes(max(max_packet, USB_READ_SIZE // max_packet * max_packet)))
+        view = memoryview(buf)
+        while self.connected:
             try:
-                data = endpoint_in.read(1024, timeout=1000)  # Read up to 1024 bytes with a timeout
-                data_string = data.tobytes().decode('utf-8', errors='replace')
-                log.info("Received data from USB:{}".format(data_string))
-                out_sock.send(data)
+                size = self.endpoint_in.read(buf, timeout=1000)  # Read up to len(buf) bytes with a timeout
+                if not size:
+                    continue
+                if log.isEnabledFor(logging.DEBUG):
+                    log.debug("Received data from USB {}:{}".format(
+                        self.identity, view[:size].tobytes().decode('utf-8', errors='replace')))
+                if self.attached_at is not None:
+                    self.first_byte()
+                self.publish(view[:size])
+                meter.add(size)
 
             except usb.core.USBError as e:
                 if e.errno == 110:
                     # log.info("Read timeout. Continuing...")
                     continue
                 else:
-                    log.error("Read thread USB error:{}".format(e))
-                    running = False  # Stop the threads
+                    log.error("Read thread USB error {}:{}".format(self.identity, e))
+                    self.detach()  # Stop the threads
                     break
             except Exception as e:
-                log.error("Read thread unexpected error:{}".format(e))
-                running = False  # Stop the threads
+                log.error("Read thread unexpected error {}:{}".format(self.identity, e))
+                self.detach()  # Stop the threads
                 break
 
-    @staticmethod
-    def write_to_accessory(endpoint_out):
+    def write_to_accessory(self):
         """
-        Write data back
-        :param endpoint_out:
+        Write data back to whichever accessory is attached
         :return:
         """
-        
-        global running
-        while running:
-            while in_sock.getsockopt(zmq.EVENTS):
-                try:
-                    data = in_sock.recv(flags=zmq.NOBLOCK)      # Don't block or it can hold up all the code
-                except usb.core.USBError as e:
-                    if e.errno == 110:  # errno 110 is a timeout error
-                        # log.info("Read timeout occurred. Handling it.")
-                        continue
-                    else:
-                        log.error("Device disconnected or read error:{}".format(e))
-                        running = False  # Stop the threads
-                        break
-                except Exception as e:
-                    log.error("Unexpected error:{}".format(e))
-                    running = False  # Stop the threads
-                    break
-                else:
-                    if data:
-                        endpoint_out.write(data)
-                        log.info("Sending data to USB:{}".format(data))
+        poller = zmq.Poller()
+        poller.register(self.in_sock, zmq.POLLIN)
+        while self.wait_attached():
+            self.write_attachment(poller)
+            self.attachment_done()
+        self.in_sock.close()
 
+    def replay_spool(self, spool, send, max_packet):
+        """
+        Send what was spooled while no accessory was attached in bulk writes
+        as large as allowed. Records only leave the spool once the endpoint
+        took them, a failed write leaves the rest for the next accessory.
+        """
+        start = time.monotonic()
+        messages = nbytes = 0
+        added = written = 0
+        ends = collections.deque()      # (bytes added up to a record, its spool offset)
 
-def main():
-    android = Android()
-    global running
-    
-    while True:
-        running = True
-        log.info("\n--------------------\n........ Searching for device as USB...")
-        accessory = android.identify_android_device_as_usb()
-        if accessory:
-            log.info("Device found and switched to accessory mode.")
-            try:
+        def write(data, payload):
+            nonlocal written
+            send(data)
+            written += len(data)
+            end = None
+            while ends and ends[0][0] <= written:
+                end = ends.popleft()[1]
+            if end is not None:
+                spool.release(end)
 
-                log.info("Step 1 done")
-                # Get endpoints based on product ID
-                if accessory.idProduct == 0x2D00:
-                    endpoint_in, endpoint_out = android.get_bulk_endpoints(accessory, 0)
-                elif accessory.idProduct == 0x2D01:
-                    # Standard communication endpoints
-                    endpoint_in, endpoint_out = android.get_bulk_endpoints(accessory, 0)
-                    # ADB communication endpoints (if needed)
-                    # adb_ep_in, adb_ep_out = get_bulk_endpoints(accessory, 1)
-                log.info("Step 2 done")
-                
-                if endpoint_in is not None and endpoint_out is not None:
-                    read_thread = threading.Thread(target=android.read_from_accessory, args=(endpoint_in,))
-                    write_thread = threading.Thread(target=android.write_to_accessory, args=(endpoint_out,))
-
-                    read_thread.start()
-                    write_thread.start()
-                    log.info("Threads started")
-
-                    read_thread.join()
-                    write_thread.join()
-
-                    log.info("Continue Main loop after finish")
-                else:
-                    log.info("Endpoints not found.")
+        egress = BulkWriter(write, max_packet, max_delay=0)
+        try:
+            for end, data in spool.peek():
+                data = encode_message(data) if USB_FRAMED else data
+                added += len(data)
+                ends.append((added, end))
+                egress.add(data)
+                messages += 1
+                nbytes += len(data)
+            egress.flush()
+        except usb.core.USBError as e:
+            log.error("Replay to USB {} failed, {} bytes left spooled:{}".format(self.identity, len(spool), e))
+            self.detach()
+            return
+        finally:
+            spool.flush()
+        if messages:
+            log.info("Replayed {} spooled messages ({} bytes) to {} in {:.1f} ms".format(
+                messages, nbytes, self.identity, (time.monotonic() - start) * 1000))
+
+    def write_attachment(self, poller):
+        """
+        Write data back. Blocks on the SUB socket for up to WRITE_POLL_TIMEOUT
+        so a shutdown is still noticed. Queued messages are packed into bulk
+        writes of up to USB_WRITE_SIZE and held back at most USB_WRITE_DELAY
+        seconds, see BulkWriter
+        :return:
+        """
+
+        # Only a consumer while an accessory is attached, so a missing phone
+        # doesn't hold up the UartServer
+        credits = CreditGranter(context, "usb-{}".format(self.identity))
+        max_packet = self.endpoint_out.wMaxPacketSize
+
+        def send(data):
+            self.endpoint_out.write(data)
+            if self.attached_at is not None:
+                self.first_byte()
 
+        def write(data, payload):
+            try:
+                send(data)
+                credits.done(payload)
+                if log.isEnabledFor(logging.DEBUG):
+                    log.debug("Sending data to USB {}:{}".format(self.identity, data))
             except usb.core.USBError as e:
-                log.error("Error setting configuration:{}".format(e))
-                usb.util.dispose_resources(accessory)
+                credits.drop(payload, "usb write: {}".format(e))
+                if e.errno != 110:  # errno 110 is a timeout error
+                    log.error("Device disconnected or read error {}:{}".format(self.identity, e))
+                    self.detach()  # Stop the threads
+
+        self.dispatcher.open_route(self.identity, lambda spool: self.replay_spool(spool, send, max_packet))
+        egress = BulkWriter(write, max_packet)
+        try:
+            while self.connected:
+                timeout = egress.timeout()
+                poller.poll(WRITE_POLL_TIMEOUT if timeout is None else timeout)
+                count = 0
+                while count < WRITE_BATCH and self.in_sock.getsockopt(zmq.EVENTS) & zmq.POLLIN:
+                    data = self.in_sock.recv_multipart()[-1]
+                    if data:
+                        egress.add(encode_message(data) if USB_FRAMED else data, len(data))
+                    count += 1
+                egress.flush_due()
+            egress.flush()
+        except Exception as e:
+            log.error("Unexpected error {}:{}".format(self.identity, e))
+            self.detach()  # Stop the threads
+        dropped, dropped_bytes = self.dispatcher.close_route(self.identity, self.in_sock)
+        if dropped:
+            credits.drop(dropped_bytes, "{} messages left at detach".format(dropped))
+        log.info("USB OUT {}: {}".format(self.identity, egress.stats()))
+        credits.close()
+
+
+class AccessoryManager:
+    """
+    Runs one AccessorySession per port with an accessory on it, keyed by
+    identity. Endpoint layouts are remembered per port, so a phone coming
+    back is attached straight to its known endpoint addresses. The uart
+    dispatcher and its spool belong to the manager and outlive the sessions.
+    """
+
+    def __init__(self, android):
+        self.android = android
+        self.sessions = {}
+        self.layouts = {}
+        spool = None
+        if SPOOL_DIR is not None:
+            os.makedirs(SPOOL_DIR, exist_ok=True)
+            spool = Spool(os.path.join(SPOOL_DIR, "uart.spool"))
+        self.dispatcher = UartDispatcher(spool)
+        self.dispatcher.start()
+
+    def endpoints(self, accessory, identity):
+        """
+        :return: the accessory's bulk endpoints, from the cached layout when
+                 the same kind of accessory was on this port before
+        """
+        layout = self.layouts.get(identity)
+        if layout is not None and layout[0] == accessory.idProduct:
+            _, in_address, in_size, out_address, out_size = layout
+            return EndpointRef(accessory, in_address, in_size), EndpointRef(accessory, out_address, out_size)
+
+        endpoint_in, endpoint_out = self.android.get_bulk_endpoints(accessory, 0)
+        if endpoint_in is not None and endpoint_out is not None:
+            self.layouts[identity] = (accessory.idProduct,
+                                      endpoint_in.bEndpointAddress, endpoint_in.wMaxPacketSize,
+                                      endpoint_out.bEndpointAddress, endpoint_out.wMaxPacketSize)
+        return endpoint_in, endpoint_out
+
+    def attach(self, accessory):
+        identity = device_identity(accessory)
+        try:
+            endpoint_in, endpoint_out = self.endpoints(accessory, identity)
+        except usb.core.USBError as e:
+            log.error("Error setting configuration:{}".format(e))
+            usb.util.dispose_resources(accessory)
+            return
+        if endpoint_in is None or endpoint_out is None:
+            log.info("Endpoints not found.")
+            return
+
+        session = self.sessions.get(identity)
+        if session is None:
+            session = AccessorySession(identity, self.dispatcher)
+            session.start()
+            self.sessions[identity] = session
         else:
-            log.info("No Android device found in accessory mode.")
-            
-        time.sleep(3)  # Wait for 3 seconds before searching again
+            log.info("Session {} back after {:.1f} s".format(identity, time.monotonic() - session.detached_at))
+            self.release(session)
+        session.attach(endpoint_in, endpoint_out)
+
+    def release(self, session):
+        """
+        Let go of the device a parked session last had
+        """
+        if session.endpoint_in is not None:
+            usb.util.dispose_resources(session.endpoint_in.device)
+            session.endpoint_in = session.endpoint_out = None
+            log.info("Session {} detached: {}, uart: {}".format(
+                session.identity, session.stats(), self.dispatcher.stats()))
+
+    def busy(self):
+        """
+        :return: identities of the sessions that can't take an accessory now
+        """
+        return {identity for identity, session in self.sessions.items() if not session.idle()}
+
+    def reap(self):
+        """
+        Release the device of sessions that lost their accessory, and stop
+        the ones nothing came back to within REATTACH_TIMEOUT
+        """
+        now = time.monotonic()
+        for identity, session in list(self.sessions.items()):
+            if not session.idle():
+                continue
+            self.release(session)
+            if now - session.detached_at > REATTACH_TIMEOUT:
+                session.stop()
+                del self.sessions[identity]
+
+    def run(self):
+        while True:
+            self.reap()
+            busy = self.busy()
+            log.info("\n--------------------\n........ Searching for device as USB ({} attached)...".format(
+                len(busy)))
+            accessory = self.android.identify_android_device_as_usb(exclude=busy)
+            if accessory:
+                log.info("Device {} found and switched to accessory mode.".format(device_identity(accessory)))
+                self.attach(accessory)
+                continue    # look for the next phone straight away
+            log.info("No new Android device found in accessory mode.")
+            self.android.watcher.wait(RESCAN_INTERVAL)  # Search again once a device arrives
+
+
+def main():
+    manager = AccessoryManager(Android())
+    manager.run()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,689 @@
+"""
+Micro benchmarks for the bridges. Nothing here needs the real hardware, the
+UART is emulated with a pty.
+
+    python3 bench.py uart-loop
+    python3 bench.py uart-alloc
+    python3 bench.py usb-writer     (needs pyusb, not a device)
+    python3 bench.py usb-read-alloc (needs pyusb, not a device)
+    python3 bench.py usb-async      (needs pyusb, not a device)
+    python3 bench.py gatt-objects   (needs dbus and a system bus)
+    python3 bench.py hub            (needs pyusb and gi, dbus is optional)
+    python3 bench.py transport
+"""
+import os
+import sys
+import time
+import select
+import subprocess
+import logging
+import argparse
+import threading
+import tracemalloc
+
+import zmq
+
+log = logging.getLogger("bench")
+
+
+class PtyUart:
+    """
+    Pseudo terminal standing in for the serial port. The server opens
+    self.name, the benchmark plays the device side through self.master.
+    """
+
+    def __init__(self):
+        import tty
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.slave)
+        self.name = os.ttyname(self.slave)
+
+    def read(self, size=4096):
+        return os.read(self.master, size)
+
+    def write(self, data):
+        os.write(self.master, data)
+
+    def close(self):
+        os.close(self.master)
+        os.close(self.slave)
+
+
+def wait_subscribed(pub, sub):
+    """
+    Send probes until sub receives one, PUB drops everything before the
+    subscription has reached it
+    """
+    while True:
+        pub.send(b"")
+        if sub.poll(50):
+            while sub.poll(50):
+                sub.recv()
+            return
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def cpu_usage(duration):
+    """
+    Fraction of one core the whole process uses over duration seconds
+    """
+    cpu, wall = time.process_time(), time.monotonic()
+    time.sleep(duration)
+    return (time.process_time() - cpu) / (time.monotonic() - wall)
+
+
+def bench_uart_loop(args):
+    """
+    Idle CPU and ZMQ -> uart -> ZMQ round trip latency for each UartServer loop
+    """
+    import uart
+    uart.log.setLevel(logging.WARNING)
+
+    for mode in ("spin", "poll"):
+        pty = PtyUart()
+        server = uart.UartServer(port=pty.name,
+                                 in_addr="tcp://127.0.0.1:15555",
+                                 out_addr="tcp://127.0.0.1:15556")
+        thread = threading.Thread(target=server.run, args=(mode,), daemon=True)
+        thread.start()
+
+        ctx = zmq.Context()
+        to_uart = ctx.socket(zmq.PUB)
+        to_uart.connect("tcp://127.0.0.1:15555")
+        from_uart = ctx.socket(zmq.SUB)
+        from_uart.connect("tcp://127.0.0.1:15556")
+        from_uart.setsockopt_string(zmq.SUBSCRIBE, "")
+        time.sleep(0.5)  # let the subscriptions propagate
+
+        idle = cpu_usage(args.duration)
+
+        latencies = []
+        for i in range(args.count):
+            msg = b"ping %05d\n" % i
+            start = time.perf_counter()
+            to_uart.send(msg)
+            echoed = b""
+            while len(echoed) < len(msg):
+                echoed += pty.read()
+            pty.write(echoed)
+            received = b""
+            while len(received) < len(msg):
+                received += from_uart.recv()
+            latencies.append((time.perf_counter() - start) * 1e6)
+
+        server.stop()
+        thread.join()
+        server.close()
+        to_uart.close(linger=0)
+        from_uart.close(linger=0)
+        ctx.term()
+        pty.close()
+
+        print("{:5s} idle cpu {:6.1%}  rtt p50 {:7.0f}us  p99 {:7.0f}us".format(
+            mode, idle, percentile(latencies, 50), percentile(latencies, 99)))
+
+
+def bench_uart_alloc(args):
+    """
+    Transient memory allocated per message on each direction of UartServer,
+    default copying path against zero_copy
+    """
+    import uart
+    uart.log.setLevel(logging.WARNING)
+    size = args.size
+
+    for zero_copy in (False, True):
+        pty = PtyUart()
+        server = uart.UartServer(port=pty.name,
+                                 in_addr="tcp://127.0.0.1:15555",
+                                 out_addr="tcp://127.0.0.1:15556",
+                                 zero_copy=zero_copy)
+        ctx = zmq.Context()
+        to_uart = ctx.socket(zmq.PUB)
+        to_uart.connect("tcp://127.0.0.1:15555")
+        from_uart = ctx.socket(zmq.SUB)
+        from_uart.connect("tcp://127.0.0.1:15556")
+        from_uart.setsockopt_string(zmq.SUBSCRIBE, "")
+        wait_subscribed(to_uart, server.in_skt)
+        wait_subscribed(server.out_skt, from_uart)
+
+        payload = os.urandom(size)
+        to_uart_peak, from_uart_peak = [], []
+        tracemalloc.start()
+        for _ in range(args.count):
+            # ZMQ -> uart
+            to_uart.send(payload)
+            while not server.in_skt.poll(1000):
+                pass
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+            server.drain_socket()
+            to_uart_peak.append(tracemalloc.get_traced_memory()[1] - base)
+            received = 0
+            while received < size:
+                received += len(pty.read())
+
+            # uart -> ZMQ
+            pty.write(payload)
+            while server.uart.in_waiting < size:
+                time.sleep(0.0001)
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+            server.drain_uart()
+            from_uart_peak.append(tracemalloc.get_traced_memory()[1] - base)
+            received = 0
+            while received < size:
+                received += len(from_uart.recv())
+        tracemalloc.stop()
+
+        server.close()
+        to_uart.close(linger=0)
+        from_uart.close(linger=0)
+        ctx.term()
+        pty.close()
+
+        print("{:9s} {}B msgs: zmq->uart {:6.0f} B/msg  uart->zmq {:6.0f} B/msg".format(
+            "zero-copy" if zero_copy else "copy", size,
+            sum(to_uart_peak) / len(to_uart_peak), sum(from_uart_peak) / len(from_uart_peak)))
+
+
+class NullEndpoint:
+    """
+    Bulk endpoint that swallows everything written to it and never has
+    anything to read
+    """
+
+    wMaxPacketSize = 512
+    device = None
+
+    def __init__(self):
+        self.writes = 0
+
+    def read(self, size_or_buffer, timeout=None):
+        import usb.core
+        time.sleep(timeout / 1000)
+        raise usb.core.USBError("Operation timed out", errno=110)
+
+    def write(self, data):
+        self.writes += 1
+        return len(data)
+
+
+class PatternEndpoint:
+    """
+    Bulk IN endpoint that returns the same payload count times, then stops
+    the session reading it. Records the memory allocated between reads.
+    """
+    wMaxPacketSize = 512
+    device = None
+
+    def __init__(self, session, payload, count):
+        self.session = session
+        self.payload = payload
+        self.count = count
+        self.peaks = []
+        self.base = None
+
+    def read(self, size_or_buffer, timeout=None):
+        if self.base is not None:
+            self.peaks.append(tracemalloc.get_traced_memory()[1] - self.base)
+        self.count -= 1
+        if self.count <= 0:
+            self.session.connected = False
+        if isinstance(size_or_buffer, int):
+            import array
+            data = array.array("B", self.payload[:size_or_buffer])
+        else:
+            size_or_buffer[:len(self.payload)] = array_of(self.payload)
+            data = len(self.payload)
+        tracemalloc.reset_peak()
+        self.base = tracemalloc.get_traced_memory()[0]
+        return data
+
+
+def array_of(payload, _cache={}):
+    if payload not in _cache:
+        import array
+        _cache[payload] = array.array("B", payload)
+    return _cache[payload]
+
+
+def bench_usb_read_alloc(args):
+    """
+    Transient memory allocated per bulk IN read by android2's synchronous
+    reader, from the endpoint read to the ZMQ publish
+    """
+    import android2
+    android2.log.setLevel(logging.WARNING)
+    android2.USB_READ_DEPTH = 0
+
+    size = min(args.size, 1024)
+    session = android2.AccessorySession("bench", None)
+    session.endpoint_in = PatternEndpoint(session, os.urandom(size), args.count)
+    session.connected = True
+    tracemalloc.start()
+    start = time.perf_counter()
+    session.read_from_accessory_sync(android2.RateMeter("bench"))
+    elapsed = time.perf_counter() - start
+    tracemalloc.stop()
+    session.in_sock.close()
+    session.out_sock.close()
+    peaks = session.endpoint_in.peaks
+    print("{}B reads: {:6.0f} B/read  {:8.0f} reads/s".format(
+        size, sum(peaks) / len(peaks), args.count / elapsed))
+
+
+class FakeLibusb:
+    """
+    Just enough of libusb for usb_async.AsyncBulkReader: every event loop
+    pass completes the submitted transfers with payload, and stops session
+    after count of them
+    """
+
+    def __init__(self, session, payload, count):
+        self.session = session
+        self.payload = payload
+        self.count = count
+        self.submitted = []
+        self.cancelled = []
+
+        # _setup_prototypes sets argtypes on these, bound methods won't take them
+        self.libusb_cancel_transfer = lambda transfer: self.cancelled.append(transfer) or 0
+        self.libusb_handle_events_timeout = lambda ctx, tv: self.handle_events()
+
+    def libusb_alloc_transfer(self, iso_packets):
+        import ctypes
+        import usb.backend.libusb1 as libusb1
+        return ctypes.pointer(libusb1._libusb_transfer())
+
+    def libusb_submit_transfer(self, transfer):
+        self.submitted.append(transfer)
+        return 0
+
+    def libusb_free_transfer(self, transfer):
+        pass
+
+    def handle_events(self):
+        import ctypes
+        for transfer in self.cancelled:
+            if transfer in self.submitted:
+                self.submitted.remove(transfer)
+                transfer.contents.status = 3    # LIBUSB_TRANSFER_CANCELLED
+                transfer.contents.callback(transfer)
+        self.cancelled = []
+        submitted, self.submitted = self.submitted, []
+        for transfer in submitted:
+            t = transfer.contents
+            size = min(len(self.payload), t.length)
+            ctypes.memmove(t.buffer, self.payload, size)
+            t.actual_length = size
+            t.status = 0
+            t.callback(transfer)
+            self.count -= 1
+            if self.count <= 0:
+                self.session.connected = False
+        return 0
+
+
+def fake_accessory(lib):
+    """
+    pyusb Device on a libusb1 backend that never touches a bus, one
+    interface with bulk endpoints 0x81 and 0x01
+    """
+    import types
+    import usb.core
+    import usb.backend.libusb1 as libusb1
+
+    def desc(**fields):
+        return types.SimpleNamespace(bLength=0, bDescriptorType=0, extra_descriptors=[], **fields)
+
+    endpoints = [desc(bEndpointAddress=0x81, bmAttributes=2, wMaxPacketSize=512, bInterval=0,
+                      bRefresh=0, bSynchAddress=0),
+                 desc(bEndpointAddress=0x01, bmAttributes=2, wMaxPacketSize=512, bInterval=0,
+                      bRefresh=0, bSynchAddress=0)]
+
+    class Backend(libusb1._LibUSB):
+        def __init__(self):
+            self.lib = lib
+            self.ctx = None
+
+        def get_device_descriptor(self, dev):
+            return desc(bcdUSB=0x200, bDeviceClass=0, bDeviceSubClass=0, bDeviceProtocol=0,
+                        bMaxPacketSize0=64, idVendor=0x18D1, idProduct=0x2D00, bcdDevice=0,
+                        iManufacturer=0, iProduct=0, iSerialNumber=0, bNumConfigurations=1,
+                        address=2, bus=1, port_number=1, port_numbers=(1,), speed=3)
+
+        def get_configuration_descriptor(self, dev, config):
+            return desc(wTotalLength=0, bNumInterfaces=1, bConfigurationValue=1,
+                        iConfiguration=0, bmAttributes=0x80, bMaxPower=50)
+
+        def get_interface_descriptor(self, dev, intf, alt, config):
+            if intf or alt:
+                raise IndexError
+            return desc(bInterfaceNumber=0, bAlternateSetting=0, bNumEndpoints=2,
+                        bInterfaceClass=0xFF, bInterfaceSubClass=0xFF, bInterfaceProtocol=0,
+                        iInterface=0)
+
+        def get_endpoint_descriptor(self, dev, ep, intf, alt, config):
+            return endpoints[ep]
+
+        def open_device(self, dev):
+            return types.SimpleNamespace(handle=None)
+
+        def close_device(self, dev_handle):
+            pass
+
+        def get_configuration(self, dev_handle):
+            return 1
+
+        def claim_interface(self, dev_handle, intf):
+            pass
+
+        def release_interface(self, dev_handle, intf):
+            pass
+
+    return usb.core.Device(object(), Backend())
+
+
+def bench_usb_async(args):
+    """
+    Bulk IN reads through usb_async on a returning accessory, whose endpoints
+    are EndpointRefs from the cached layout, on a stand-in libusb
+    """
+    import android2
+    android2.log.setLevel(logging.WARNING)
+
+    size = min(args.size, 16384)
+    session = android2.AccessorySession("bench", None)
+    lib = FakeLibusb(session, os.urandom(size), args.count)
+    accessory = fake_accessory(lib)
+    session.endpoint_in = android2.EndpointRef(accessory, 0x81, 512)
+    session.connected = True
+    start = time.perf_counter()
+    session.read_from_accessory_async(android2.RateMeter("bench"))
+    elapsed = time.perf_counter() - start
+    session.in_sock.close()
+    session.out_sock.close()
+    done = args.count - max(lib.count, 0)
+    print("{}B transfers: {} of {} read, {:8.0f} transfers/s".format(
+        size, done, args.count, done / elapsed))
+
+
+def bench_usb_writer(args):
+    """
+    Idle CPU of an android2 session with an accessory attached but no traffic
+    """
+    import android2
+    android2.log.setLevel(logging.WARNING)
+    android2.USB_READ_DEPTH = 0
+
+    dispatcher = android2.UartDispatcher()
+    session = android2.AccessorySession("bench", dispatcher)
+    session.start()
+    session.attach(NullEndpoint(), NullEndpoint())
+    idle = cpu_usage(args.duration)
+    session.stop()
+    dispatcher.stop()
+    print("usb session idle cpu {:6.1%}".format(idle))
+
+
+def bench_gatt_objects(args):
+    """
+    Application.GetManagedObjects on a large synthetic GATT tree, rebuilt on
+    every call (the old behaviour) against the cached response. Only the
+    Python side is timed, not the D-Bus marshalling.
+    """
+    import dbus
+    import gatt_server
+
+    services, chrcs, descs = 20, 10, 3
+    uuid = '12345678-1234-5678-1234-56789abcdef0'
+
+    bus = dbus.SystemBus()
+    app = gatt_server.Application(bus)
+    for i in range(services):
+        service = gatt_server.Service(bus, i, uuid, True)
+        for j in range(chrcs):
+            chrc = gatt_server.Characteristic(bus, j, uuid, ['read', 'notify'], service)
+            for k in range(descs):
+                chrc.add_descriptor(gatt_server.Descriptor(bus, k, uuid, ['read'], chrc))
+            service.add_characteristic(chrc)
+        app.add_service(service)
+
+    objects = len(app.GetManagedObjects())
+    for cached in (False, True):
+        start = time.perf_counter()
+        for _ in range(args.count):
+            if not cached:
+                app.invalidate()
+            app.GetManagedObjects()
+        elapsed = time.perf_counter() - start
+        print("{:7s} {} objects: {:8.1f}us per call".format(
+            "cached" if cached else "rebuilt", objects, elapsed / args.count * 1e6))
+
+
+def relay(ctx, from_addr, to_addr):
+    """
+    Stands in for a bridge in bench_hub: sends everything it gets from the
+    uart straight back
+    """
+    from_uart = ctx.socket(zmq.SUB)
+    from_uart.connect(from_addr)
+    from_uart.setsockopt_string(zmq.SUBSCRIBE, "")
+    to_uart = ctx.socket(zmq.PUB)
+    to_uart.connect(to_addr)
+    while True:
+        to_uart.send(from_uart.recv())
+
+
+def import_ble():
+    """
+    :return: False if the BLE bridge can't be loaded here (no dbus / gi)
+    """
+    try:
+        import bluetooth2
+    except ImportError:
+        return False
+    return True
+
+
+def hub_part(role, port):
+    """
+    One process of bench_hub, run with python3 -c
+    """
+    logging.basicConfig(level=logging.WARNING)
+    if role == "uart":
+        import uart
+        uart.log.setLevel(logging.WARNING)
+        uart.UartServer(port=port, in_addr="tcp://127.0.0.1:15555",
+                        out_addr="tcp://127.0.0.1:15556").run()
+    elif role == "usb":
+        import android2
+        relay(android2.context, "tcp://127.0.0.1:15556", "tcp://127.0.0.1:15555")
+    elif role == "ble":
+        import_ble()
+        while True:
+            time.sleep(60)
+    elif role == "hub":
+        from gi.repository import GLib
+        import hub
+        import uart
+        import android2
+        import endpoints
+        import_ble()
+        uart.log.setLevel(logging.WARNING)
+        endpoints.TRANSPORT = "inproc"
+        server = uart.UartServer(port=port, ctx=zmq.Context.instance())
+        threading.Thread(target=relay, args=(android2.context, endpoints.connect_addr(endpoints.FROM_UART),
+                                             endpoints.connect_addr(endpoints.TO_UART)),
+                         daemon=True).start()
+        hub.GlibUart(server)
+        GLib.MainLoop().run()
+
+
+def memory_of(pids):
+    """
+    :return: summed RSS and PSS in kB, PSS splits shared pages between the
+             processes mapping them
+    """
+    rss = pss = 0
+    for pid in pids:
+        with open("/proc/{}/smaps_rollup".format(pid)) as f:
+            for line in f:
+                if line.startswith("Rss:"):
+                    rss += int(line.split()[1])
+                elif line.startswith("Pss:"):
+                    pss += int(line.split()[1])
+    return rss, pss
+
+
+def echo_round_trip(pty, msg, timeout=None):
+    """
+    Write msg to the uart and wait for it to come back from the bridge
+    :return: False on timeout
+    """
+    pty.write(msg)
+    received = b""
+    while len(received) < len(msg):
+        if not select.select([pty.master], [], [], timeout)[0]:
+            return False
+        received += pty.read()
+    return True
+
+
+def bench_hub(args):
+    """
+    Memory and uart -> bridge -> uart latency of the three process layout
+    (main.py, tcp) against the single process hub (hub.py, inproc). The
+    bridges are relays that send the uart data straight back, so no phone
+    is needed, but each process imports its real bridge module.
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    if not import_ble():
+        print("(BLE bridge not importable here, its process only holds an interpreter)")
+
+    for layout, roles in (("3 processes", ("uart", "usb", "ble")), ("hub", ("hub",))):
+        pty = PtyUart()
+        parts = []
+        for role in roles:
+            parts.append(subprocess.Popen(
+                [sys.executable, "-c", "import bench; bench.hub_part({!r}, {!r})".format(role, pty.name)],
+                cwd=here))
+            if role == "uart":
+                time.sleep(0.3)     # the bridges connect to its sockets
+
+        # Probe until the bridge's subscription has gone through
+        while not echo_round_trip(pty, b"probe\n", timeout=0.1):
+            pass
+        while select.select([pty.master], [], [], 0.2)[0]:
+            pty.read()
+
+        latencies = []
+        for i in range(args.count):
+            msg = b"ping %05d\n" % i
+            start = time.perf_counter()
+            echo_round_trip(pty, msg)
+            latencies.append((time.perf_counter() - start) * 1e6)
+        rss, pss = memory_of(part.pid for part in parts)
+
+        for part in parts:
+            part.kill()
+            part.wait()
+        pty.close()
+        print("{:11s} rss {:6.1f} MB  pss {:6.1f} MB  rtt p50 {:6.0f}us  p99 {:6.0f}us".format(
+            layout, rss / 1024, pss / 1024, percentile(latencies, 50), percentile(latencies, 99)))
+
+
+def bench_transport(args):
+    """
+    PUB/SUB between the hub and a bridge over each transport in
+    endpoints.py: round trip latency through a relay thread, and one way
+    throughput of 20x --count messages
+    """
+    import tempfile
+    import endpoints
+
+    # Stay clear of the sockets of a hub running on this machine
+    endpoints.IPC_DIR = tempfile.mkdtemp()
+    endpoints.TCP_PORTS = {name: port + 10000 for name, port in endpoints.TCP_PORTS.items()}
+    payload = b"x" * args.size
+
+    for transport in endpoints.TRANSPORTS:
+        ctx = zmq.Context()
+        from_uart = ctx.socket(zmq.PUB)
+        from_uart.setsockopt(zmq.SNDHWM, 0)     # queue all of them, nothing dropped
+        from_uart.bind(endpoints.bind_addr(endpoints.FROM_UART, transport))
+        bridge = ctx.socket(zmq.SUB)
+        bridge.setsockopt(zmq.RCVHWM, 0)
+        bridge.connect(endpoints.connect_addr(endpoints.FROM_UART, transport))
+        bridge.setsockopt_string(zmq.SUBSCRIBE, "")
+        wait_subscribed(from_uart, bridge)
+
+        count = args.count * 20
+        receiver = threading.Thread(target=lambda: [bridge.recv() for _ in range(count)])
+        start = time.perf_counter()
+        receiver.start()
+        for _ in range(count):
+            from_uart.send(payload)
+        receiver.join()
+        elapsed = time.perf_counter() - start
+        from_uart.close(linger=0)
+        bridge.close(linger=0)
+        ctx.term()
+
+        # The relay thread never returns, its context is left behind
+        ctx = zmq.Context()
+        from_uart = ctx.socket(zmq.PUB)
+        from_uart.bind(endpoints.bind_addr(endpoints.FROM_UART, transport))
+        to_uart = ctx.socket(zmq.SUB)
+        to_uart.bind(endpoints.bind_addr(endpoints.TO_UART, transport))
+        to_uart.setsockopt_string(zmq.SUBSCRIBE, "")
+        threading.Thread(target=relay, args=(ctx, endpoints.connect_addr(endpoints.FROM_UART, transport),
+                                             endpoints.connect_addr(endpoints.TO_UART, transport)),
+                         daemon=True).start()
+        wait_subscribed(from_uart, to_uart)
+
+        latencies = []
+        for _ in range(args.count):
+            start_rtt = time.perf_counter()
+            from_uart.send(payload)
+            to_uart.recv()
+            latencies.append((time.perf_counter() - start_rtt) * 1e6)
+
+        print("{:6s} {:5d}B  rtt p50 {:6.0f}us  p99 {:6.0f}us  {:8.0f} msg/s  {:7.1f} MB/s".format(
+            transport, args.size, percentile(latencies, 50), percentile(latencies, 99),
+            count / elapsed, count * args.size / elapsed / 1e6))
+
+
+BENCHMARKS = {
+    "uart-loop": bench_uart_loop,
+    "uart-alloc": bench_uart_alloc,
+    "usb-writer": bench_usb_writer,
+    "usb-read-alloc": bench_usb_read_alloc,
+    "usb-async": bench_usb_async,
+    "gatt-objects": bench_gatt_objects,
+    "hub": bench_hub,
+    "transport": bench_transport,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS))
+    parser.add_argument("--count", type=int, default=1000, help="messages per run")
+    parser.add_argument("--size", type=int, default=1024, help="message size in bytes")
+    parser.add_argument("--duration", type=float, default=2.0, help="idle measurement seconds")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    BENCHMARKS[args.benchmark](args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
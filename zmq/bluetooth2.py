@@ -1,5 +1,6 @@
 import zmq
 import dbus
+import time
 import select
 import logging
 import dbus.mainloop.glib
@@ -8,8 +9,11 @@ from gi.repository import GLib
 
 from advertisement  import Advertisement
 from advertisement  import register_ad_cb, register_ad_error_cb
-from gatt_server    import Service, Characteristic
+from gatt_server    import Service, Characteristic, Application
 from gatt_server    import register_app_cb, register_app_error_cb
+from credit         import CreditGranter
+
+import endpoints
 
 BLUEZ_SERVICE_NAME              = 'org.bluez'
 DBUS_OM_IFACE                   = 'org.freedesktop.DBus.ObjectManager'
@@ -21,43 +25,164 @@ UART_RX_CHARACTERISTIC_UUID     = '6e400002-b5a3-f393-e0a9-e50e24dcca9e'
 UART_TX_CHARACTERISTIC_UUID     = '6e400003-b5a3-f393-e0a9-e50e24dcca9e'
 LOCAL_NAME                      = 'rpi-gatt-server'
 
+DEFAULT_MTU                     = 23    # ATT_MTU until the client negotiates a bigger one
+ATT_NOTIFY_OVERHEAD             = 3     # opcode + attribute handle
+TX_DEPTH                        = 4     # notifications handed to BlueZ per main loop pass
+TX_MAX_LATENCY                  = 10    # ms a partial notification may wait to fill up, 0 = never
+TX_QUEUE_BYTES                  = 65536 # most bytes queued for the client, more is dropped
+STATS_INTERVAL                  = 10    # seconds between TX throughput reports
+
 
-logging.basicConfig(level=logging.DEBUG)
+logging.basicConfig(level=logging.INFO)  # DEBUG logs every message, slow at full BLE speed
 log = logging.getLogger("bluetooth")
 
 mainloop = None
 
-context = zmq.Context()
+# Shared with the other bridges when they run in one process (hub.py)
+context = zmq.Context.instance()
 
-# Client code that connects to the UartServer publisher (receives from the uart)
-in_sock = context.socket(zmq.SUB)
-in_sock.connect("tcp://localhost:5556")
-in_sock.setsockopt_string(zmq.SUBSCRIBE, "")
+# Sockets to the UartServer and the credit granter, set up by connect()
+in_sock = None
+out_sock = None
+credits = None
 
 
-# Server Code that connects to the UartServers subscriber (sends to the uart)
-out_sock = context.socket(zmq.PUB)
-out_sock.connect("tcp://localhost:5555")
+def connect():
+    global in_sock, out_sock, credits
 
+    # Client code that connects to the UartServer publisher (receives from the uart)
+    in_sock = context.socket(zmq.SUB)
+    in_sock.connect(endpoints.connect_addr(endpoints.FROM_UART))
+    in_sock.setsockopt_string(zmq.SUBSCRIBE, "")
 
-class TxCharacteristic(Characteristic):
-    def __init__(self, bus, index, service):
+    # Server Code that connects to the UartServers subscriber (sends to the uart)
+    out_sock = context.socket(zmq.PUB)
+    out_sock.connect(endpoints.connect_addr(endpoints.TO_UART))
 
+    # Hands delivered bytes back to the UartServer as flow control credit
+    credits = CreditGranter(context, "ble")
+
+
+class TxCharacteristic(Characteristic):
+    def __init__(self, bus, index, service, depth=TX_DEPTH, max_latency=TX_MAX_LATENCY,
+                 max_queued=TX_QUEUE_BYTES):
+        """
+        :param depth: max notifications emitted per main loop pass, the rest
+                      waits for the next idle callback so D-Bus can drain
+        :param max_latency: ms a notification that isn't full yet waits for
+                            more data before it is sent anyway
+        :param max_queued: bytes that may wait for a client that stopped
+                           taking notifications, data beyond is dropped
+        """
         Characteristic.__init__(self, bus, index, UART_TX_CHARACTERISTIC_UUID,
-                                ['notify'], service)
+                                ['notify'], service, acquire_notify=True)
         self.notifying = False
+        self.depth = depth
+        self.max_latency = max_latency
+        self.max_queued = max_queued
+        self.pending = bytearray()
+        self.flushing = False
+        self.flush_partial = False
+        self.latency_timer = None
+        self.tx_bytes = 0
+        self.tx_notifications = 0
+        self.tx_capacity = 0
+        self.stats_start = time.monotonic()
 
         GLib.io_add_watch(in_sock, GLib.IO_IN, self.read_from_uart_helper)
 
+    def payload_size(self):
+        return self.service.mtu - ATT_NOTIFY_OVERHEAD
+
     def send_tx(self, chars):
+        """
+        Queue data for the client. It goes out in MTU sized notifications,
+        a partly filled one waits up to max_latency ms for more data.
+        """
         if not self.notifying:
+            credits.drop(len(chars), "not notifying")
+            return
+        if len(self.pending) + len(chars) > self.max_queued:
+            credits.drop(len(chars), "tx queue full")
             return
 
-        value = []
-        for ch in chars:
-            value.append(dbus.Byte(ch))
-
-        self.PropertiesChanged(GATT_CHRC_IFACE, {'Value': value}, [])
+        self.pending += chars
+        if self.max_latency <= 0:
+            self.flush_partial = True
+        if len(self.pending) >= self.payload_size() or self.flush_partial:
+            self.start_flush()
+        elif self.latency_timer is None:
+            self.latency_timer = GLib.timeout_add(self.max_latency, self.on_latency_timer)
+
+    def on_latency_timer(self):
+        self.latency_timer = None
+        self.flush_partial = True
+        self.start_flush()
+        return False
+
+    def start_flush(self):
+        if not self.flushing:
+            self.flushing = True
+            if self.flush_tx():
+                GLib.idle_add(self.flush_tx)
+
+    def flush_tx(self):
+        """
+        Emit up to self.depth notifications of at most MTU - 3 bytes each.
+        The last, partial one only goes out once its latency budget is spent.
+        Stops while the notify socket is full, notify_ready() resumes.
+        :return: True while there is more to send, so GLib calls again when idle
+        """
+        payload = self.payload_size()
+        for _ in range(self.depth):
+            if self.notify_held is not None:
+                break
+            if len(self.pending) < payload and not (self.flush_partial and self.pending):
+                break
+            chunk = self.pending[:payload]
+            del self.pending[:payload]
+            self.notify(chunk, payload)
+
+        if not self.pending:
+            self.flush_partial = self.max_latency <= 0
+            self.cancel_latency_timer()
+        elif len(self.pending) < payload and not self.flush_partial and self.latency_timer is None:
+            self.latency_timer = GLib.timeout_add(self.max_latency, self.on_latency_timer)
+
+        self.flushing = self.notifying and self.notify_held is None and (
+            len(self.pending) >= payload or (self.flush_partial and bool(self.pending)))
+        return self.flushing
+
+    def notify_ready(self):
+        self.start_flush()
+
+    def cancel_latency_timer(self):
+        if self.latency_timer is not None:
+            GLib.source_remove(self.latency_timer)
+            self.latency_timer = None
+
+    def notify(self, chunk, payload):
+        if not self.notify_value(chunk):
+            credits.drop(len(chunk), "notify failed")
+            return
+        credits.done(len(chunk))
+        self.tx_bytes += len(chunk)
+        self.tx_notifications += 1
+        self.tx_capacity += payload
+
+    def report_stats(self):
+        now = time.monotonic()
+        elapsed = now - self.stats_start
+        if elapsed > 0 and self.tx_notifications:
+            log.info("TX {:.0f} B/s in {:.1f} notifications/s, avg fill {:.0%}, mtu {}, "
+                     "{} bytes queued".format(
+                        self.tx_bytes / elapsed, self.tx_notifications / elapsed,
+                        self.tx_bytes / self.tx_capacity, self.service.mtu, len(self.pending)))
+        self.tx_bytes = 0
+        self.tx_notifications = 0
+        self.tx_capacity = 0
+        self.stats_start = now
+        return self.notifying
 
     def read_from_uart_helper(self, fd, condition):
         while in_sock.getsockopt(zmq.EVENTS):
@@ -66,31 +191,50 @@ class TxCharacteristic(Characteristic):
             except Exception as e:
                 log.error("Error receiving data".format(e))
             else:
-                log.info("Data:{}".format(data))
+                if log.isEnabledFor(logging.DEBUG):
+                    log.debug("Data:{}".format(data))
                 if data:
                     self.send_tx(data)
 
         return True
 
+    def AcquireNotify(self, options):
+        self.service.update_mtu(options)
+        return Characteristic.AcquireNotify(self, options)
+
     def StartNotify(self):
         if self.notifying:
             return
         self.notifying = True
+        self.stats_start = time.monotonic()
+        GLib.timeout_add_seconds(STATS_INTERVAL, self.report_stats)
 
     def StopNotify(self):
         if not self.notifying:
             return
         self.notifying = False
+        if self.pending:
+            credits.drop(len(self.pending), "notifications stopped")
+            self.pending.clear()
+        self.cancel_latency_timer()
 
 
 class RxCharacteristic(Characteristic):
     def __init__(self, bus, index, service):
-        Characteristic.__init__(self, bus, index, UART_RX_CHARACTERISTIC_UUID, ['write','notify'], service)
+        Characteristic.__init__(self, bus, index, UART_RX_CHARACTERISTIC_UUID,
+                                ['write', 'write-without-response', 'notify'], service,
+                                acquire_write=True)
+
+    def AcquireWrite(self, options):
+        self.service.update_mtu(options)
+        return Characteristic.AcquireWrite(self, options)
 
     def WriteValue(self, value, options):
-        print('Remote: {}'.format(bytearray(value)))
+        self.service.update_mtu(options)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('Remote: {}'.format(bytes(value)))
         try:
-            out_sock.send(bytearray(value))
+            out_sock.send(value)
         except Exception as e:
             log.error("{} trying to send {}".format(e,value))
 
@@ -98,31 +242,18 @@ class RxCharacteristic(Characteristic):
 class UartService(Service):
     def __init__(self, bus, index):
         Service.__init__(self, bus, index, UART_SERVICE_UUID, True)
+        self.mtu = DEFAULT_MTU
         self.add_characteristic(TxCharacteristic(bus, 0, self))
         self.add_characteristic(RxCharacteristic(bus, 1, self))
 
-
-class Application(dbus.service.Object):
-    def __init__(self, bus):
-        self.path = '/'
-        self.services = []
-        dbus.service.Object.__init__(self, bus, self.path)
-
-    def get_path(self):
-        return dbus.ObjectPath(self.path)
-
-    def add_service(self, service):
-        self.services.append(service)
-
-    @dbus.service.method(DBUS_OM_IFACE, out_signature='a{oa{sa{sv}}}')
-    def GetManagedObjects(self):
-        response = {}
-        for service in self.services:
-            response[service.get_path()] = service.get_properties()
-            chrcs = service.get_characteristics()
-            for chrc in chrcs:
-                response[chrc.get_path()] = chrc.get_properties()
-        return response
+    def update_mtu(self, options):
+        """
+        Pick up the ATT MTU BlueZ reports in the ReadValue/WriteValue options
+        """
+        mtu = int(options.get('mtu', 0))
+        if mtu and mtu != self.mtu:
+            log.info("ATT MTU changed {} -> {}".format(self.mtu, mtu))
+            self.mtu = mtu
 
 
 class UartApplication(Application):
@@ -149,14 +280,20 @@ def find_adapter(bus):
     return None
 
 
-def main():
-    global mainloop
+def start():
+    """
+    Connect to the UartServer and register the GATT application and the
+    advertisement. Everything runs on the default GLib main context, once a
+    main loop runs it (main(), or hub.py's).
+    :return: the advertisement, None when there is no BLE adapter
+    """
     dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
     bus = dbus.SystemBus()
+    connect()
     adapter = find_adapter(bus)
     if not adapter:
         print('BLE adapter not found')
-        return
+        return None
 
     service_manager = dbus.Interface(bus.get_object(BLUEZ_SERVICE_NAME, adapter), GATT_MANAGER_IFACE)
     ad_manager = dbus.Interface(bus.get_object(BLUEZ_SERVICE_NAME, adapter),
@@ -165,8 +302,6 @@ def main():
     app = UartApplication(bus)
     adv = UartAdvertisement(bus, 0)
 
-    mainloop = GLib.MainLoop()
-
     service_manager.RegisterApplication(app.get_path(), {},
                                         reply_handler=register_app_cb,
                                         error_handler=register_app_error_cb)
@@ -174,11 +309,23 @@ def main():
     ad_manager.RegisterAdvertisement(adv.get_path(), {},
                                      reply_handler=register_ad_cb,
                                      error_handler=register_ad_error_cb)
+    return adv
+
+
+def main():
+    global mainloop
+    adv = start()
+    if adv is None:
+        return
+
+    mainloop = GLib.MainLoop()
     try:
         mainloop.run()
 
     except KeyboardInterrupt:
         adv.Release()
+    finally:
+        credits.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,169 @@
+"""
+Credit based flow control between the UART hub (uart.py) and its consumers
+(bluetooth2.py, android2.py).
+
+Each consumer PUSHes credit messages to the hub, multipart [name, kind, bytes]:
+
+    hello  register with an initial window of bytes
+    grant  that many more bytes were delivered (or dropped) and may follow,
+           from a consumer the hub doesn't know (it was expired or the hub
+           restarted) it registers again with that much credit
+    bye    unregister
+
+The hub only reads as many bytes from the uart as the consumer with the
+least credit can take, so a slow consumer makes the serial port back up
+instead of the PUB socket silently dropping at its high-water mark.
+"""
+import time
+import logging
+
+import zmq
+
+import endpoints
+
+log = logging.getLogger("credit")
+
+# Bytes a consumer lets the hub have in flight towards it
+CREDIT_WINDOW = 4096
+
+# Seconds a consumer may sit on zero credit before the hub forgets it
+CREDIT_TIMEOUT = 5.0
+
+HELLO = b"hello"
+GRANT = b"grant"
+BYE = b"bye"
+
+
+class CreditGranter:
+    """
+    Consumer side: registers with the hub and hands credit back as data is
+    delivered. Drops are counted and still return their credit, so a
+    consumer losing data never stalls the hub.
+    """
+
+    def __init__(self, ctx, name, addr=None, window=CREDIT_WINDOW):
+        """
+        :param ctx: zmq context to create the PUSH socket in
+        :param name: consumer name, unique per hub
+        :param addr: hub credit address, the endpoints.CREDIT one when None
+        :param window: bytes the hub may send ahead of delivery
+        """
+        self.name = name.encode()
+        self.window = window
+        self.skt = ctx.socket(zmq.PUSH)
+        self.skt.setsockopt(zmq.LINGER, 0)
+        self.skt.connect(endpoints.connect_addr(endpoints.CREDIT) if addr is None else addr)
+        self.pending = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.dropped_bytes = 0
+        self.send(HELLO, window)
+
+    def send(self, kind, amount):
+        try:
+            self.skt.send_multipart([self.name, kind, str(amount).encode()], flags=zmq.NOBLOCK)
+        except zmq.Again:
+            pass    # hub isn't running with credit flow control
+
+    def done(self, nbytes):
+        """
+        nbytes were delivered, give them back once half a window adds up
+        """
+        self.delivered += nbytes
+        self.grant(nbytes)
+
+    def drop(self, nbytes, reason):
+        self.dropped += 1
+        self.dropped_bytes += nbytes
+        log.warning("{} dropped {} bytes ({}), {} drops / {} bytes so far".format(
+            self.name.decode(), nbytes, reason, self.dropped, self.dropped_bytes))
+        self.grant(nbytes)
+
+    def grant(self, nbytes):
+        self.pending += nbytes
+        if self.pending >= self.window // 2:
+            self.send(GRANT, self.pending)
+            self.pending = 0
+
+    def close(self):
+        self.send(BYE, 0)
+        self.skt.close()
+
+    def stats(self):
+        return {
+            "delivered": self.delivered,
+            "dropped": self.dropped,
+            "dropped_bytes": self.dropped_bytes,
+        }
+
+
+class CreditLedger:
+    """
+    Hub side: credit left per consumer
+    """
+
+    def __init__(self, timeout=CREDIT_TIMEOUT):
+        self.timeout = timeout
+        self.credits = {}
+        self.starved_since = {}
+        self.expired = 0
+
+    def handle(self, frames):
+        """
+        :param frames: one multipart credit message
+        """
+        try:
+            name, kind, amount = frames
+            amount = int(amount)
+        except ValueError:
+            log.warning("Bad credit message: {}".format(frames))
+            return
+
+        if kind == HELLO:
+            log.info("Consumer {} joined with {} bytes".format(name.decode(), amount))
+            self.credits[name] = amount
+        elif kind == GRANT and name in self.credits:
+            self.credits[name] += amount
+        elif kind == GRANT:
+            # Its hello is gone, what it just freed is all it is known to take
+            log.info("Consumer {} rejoined with {} bytes".format(name.decode(), amount))
+            self.credits[name] = amount
+        elif kind == BYE:
+            log.info("Consumer {} left".format(name.decode()))
+            self.credits.pop(name, None)
+        if self.credits.get(name, 1) > 0:
+            self.starved_since.pop(name, None)
+
+    def available(self):
+        """
+        :return: bytes every consumer can take, None when nobody asked for
+                 flow control
+        """
+        if not self.credits:
+            return None
+        return min(self.credits.values())
+
+    def consume(self, nbytes):
+        now = time.monotonic()
+        for name in self.credits:
+            self.credits[name] -= nbytes
+            if self.credits[name] <= 0:
+                self.starved_since.setdefault(name, now)
+
+    def expire(self):
+        """
+        Forget consumers that stopped granting, they are presumably gone
+        """
+        now = time.monotonic()
+        for name, since in list(self.starved_since.items()):
+            if now - since > self.timeout:
+                log.warning("Consumer {} stopped granting credit, dropped".format(name.decode()))
+                self.credits.pop(name, None)
+                del self.starved_since[name]
+                self.expired += 1
+
+    def stats(self):
+        return {
+            "credits": {name.decode(): credit for name, credit in self.credits.items()},
+            "expired": self.expired,
+        }
@@ -0,0 +1,50 @@
+"""
+Where the UartServer (uart.py) and the bridges (android2.py, bluetooth2.py)
+meet. Every socket address is built here, so all the processes agree on it.
+
+    to-uart    UartServer SUB, the bridges PUB data for the uart
+    from-uart  UartServer PUB, the bridges SUB to data from the uart
+    credit     UartServer PULL, the bridges PUSH flow control credit
+
+Transports:
+
+    ipc     Unix domain sockets, for processes on the same Pi (default)
+    tcp     for clients on another host, like test.py
+    inproc  for components sharing one process and zmq context (hub.py)
+"""
+
+TO_UART = "to-uart"
+FROM_UART = "from-uart"
+CREDIT = "credit"
+
+TRANSPORT = "ipc"
+TRANSPORTS = ("ipc", "tcp", "inproc")
+
+TCP_HOST = "localhost"
+TCP_PORTS = {TO_UART: 5555, FROM_UART: 5556, CREDIT: 5557}
+IPC_DIR = "/tmp"
+
+
+def address(name, transport=None, bind=False):
+    """
+    :param name: TO_UART, FROM_UART or CREDIT
+    :param transport: one of TRANSPORTS, TRANSPORT when None
+    :param bind: the address to bind to rather than to connect to, only
+                 differs for tcp
+    """
+    transport = TRANSPORT if transport is None else transport
+    if transport == "ipc":
+        return "ipc://{}/pi-{}.ipc".format(IPC_DIR, name)
+    if transport == "tcp":
+        return "tcp://{}:{}".format("*" if bind else TCP_HOST, TCP_PORTS[name])
+    if transport == "inproc":
+        return "inproc://{}".format(name)
+    raise ValueError("Unknown transport: {}".format(transport))
+
+
+def bind_addr(name, transport=None):
+    return address(name, transport, bind=True)
+
+
+def connect_addr(name, transport=None):
+    return address(name, transport)
@@ -6,11 +6,12 @@ import dbus.exceptions
 import dbus.mainloop.glib
 import dbus.service
 
-import array
+import socket
 try:
-  from gi.repository import GObject
+  from gi.repository import GLib, GObject
 except ImportError:
   import gobject as GObject
+  GLib = GObject
 import sys
 
 from random import randint
@@ -26,6 +27,13 @@ GATT_SERVICE_IFACE = 'org.bluez.GattService1'
 GATT_CHRC_IFACE =    'org.bluez.GattCharacteristic1'
 GATT_DESC_IFACE =    'org.bluez.GattDescriptor1'
 
+# ATT_MTU assumed when BlueZ doesn't pass one in the options
+DEFAULT_MTU = 23
+
+# Largest attribute value, the most a single write on an acquired fd carries
+MAX_VALUE_LEN = 512
+
+
 class InvalidArgsException(dbus.exceptions.DBusException):
     _dbus_error_name = 'org.freedesktop.DBus.Error.InvalidArgs'
 
@@ -42,28 +50,54 @@ class FailedException(dbus.exceptions.DBusException):
     _dbus_error_name = 'org.bluez.Error.Failed'
 
 
+def dbus_bytes(value):
+    """
+    Convert a characteristic/descriptor value to an 'ay' in one step.
+    bytes-like values are passed as a single ByteArray, lists of ints or
+    dbus.Byte still work but cost one object per byte.
+    """
+    if isinstance(value, dbus.ByteArray):
+        return value
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return dbus.ByteArray(bytes(value))
+    return dbus.Array(value, signature='y')
+
+
 class Application(dbus.service.Object):
     """
     org.bluez.GattApplication1 interface implementation
+
+    The GetManagedObjects response is built once and cached until the tree
+    changes, see invalidate().
     """
     def __init__(self, bus):
         self.path = '/'
         self.services = []
+        self.managed_objects = None
         dbus.service.Object.__init__(self, bus, self.path)
-        self.add_service(HeartRateService(bus, 0))
-        self.add_service(BatteryService(bus, 1))
-        self.add_service(TestService(bus, 2))
 
     def get_path(self):
         return dbus.ObjectPath(self.path)
 
     def add_service(self, service):
         self.services.append(service)
+        service.app = self
+        self.invalidate()
+
+    def invalidate(self):
+        """
+        Drop the cached GetManagedObjects response
+        """
+        self.managed_objects = None
 
     @dbus.service.method(DBUS_OM_IFACE, out_signature='a{oa{sa{sv}}}')
     def GetManagedObjects(self):
+        if self.managed_objects is None:
+            self.managed_objects = self.build_managed_objects()
+        return self.managed_objects
+
+    def build_managed_objects(self):
         response = {}
-        print('GetManagedObjects')
 
         for service in self.services:
             response[service.get_path()] = service.get_properties()
@@ -89,6 +123,7 @@ class Service(dbus.service.Object):
         self.uuid = uuid
         self.primary = primary
         self.characteristics = []
+        self.app = None
         dbus.service.Object.__init__(self, bus, self.path)
 
     def get_properties(self):
@@ -107,6 +142,11 @@ class Service(dbus.service.Object):
 
     def add_characteristic(self, characteristic):
         self.characteristics.append(characteristic)
+        self.invalidate()
+
+    def invalidate(self):
+        if self.app is not None:
+            self.app.invalidate()
 
     def get_characteristic_paths(self):
         result = []
@@ -131,32 +171,57 @@ class Characteristic(dbus.service.Object):
     """
     org.bluez.GattCharacteristic1 interface implementation
     """
-    def __init__(self, bus, index, uuid, flags, service):
+    def __init__(self, bus, index, uuid, flags, service,
+                 acquire_notify=False, acquire_write=False):
+        """
+        :param acquire_notify: offer AcquireNotify, notifications then go
+                               through a socket instead of PropertiesChanged
+        :param acquire_write: offer AcquireWrite, write-without-response
+                              values then arrive through a socket instead of
+                              WriteValue calls
+        """
         self.path = service.path + '/char' + str(index)
         self.bus = bus
         self.uuid = uuid
         self.service = service
         self.flags = flags
         self.descriptors = []
+        self.acquire_notify = acquire_notify and 'notify' in flags
+        self.acquire_write = acquire_write and 'write-without-response' in flags
+        self.notify_sock = None
+        self.notify_mtu = DEFAULT_MTU
+        self.notify_held = None     # value the notify socket had no room for
+        self.notify_watch = None
+        self.write_sock = None
+        self.write_mtu = DEFAULT_MTU
         dbus.service.Object.__init__(self, bus, self.path)
 
     def get_properties(self):
-        return {
-                GATT_CHRC_IFACE: {
-                        'Service': self.service.get_path(),
-                        'UUID': self.uuid,
-                        'Flags': self.flags,
-                        'Descriptors': dbus.Array(
-                                self.get_descriptor_paths(),
-                                signature='o')
-                }
+        properties = {
+                'Service': self.service.get_path(),
+                'UUID': self.uuid,
+                'Flags': self.flags,
+                'Descriptors': dbus.Array(
+                        self.get_descriptor_paths(),
+                        signature='o')
         }
+        # For a server the mere presence of these tells BlueZ that the
+        # Acquire* methods are implemented
+        if self.acquire_notify:
+            properties['NotifyAcquired'] = dbus.Boolean(self.notify_sock is not None)
+        if self.acquire_write:
+            properties['WriteAcquired'] = dbus.Boolean(self.write_sock is not None)
+        return {GATT_CHRC_IFACE: properties}
 
     def get_path(self):
         return dbus.ObjectPath(self.path)
 
     def add_descriptor(self, descriptor):
         self.descriptors.append(descriptor)
+        self.invalidate()
+
+    def invalidate(self):
+        self.service.invalidate()
 
     def get_descriptor_paths(self):
         result = []
@@ -183,7 +248,10 @@ class Characteristic(dbus.service.Object):
         print('Default ReadValue called, returning error')
         raise NotSupportedException()
 
-    @dbus.service.method(GATT_CHRC_IFACE, in_signature='aya{sv}')
+    # byte_arrays: subclasses get the written value as bytes, not a list of
+    # dbus.Byte
+    @dbus.service.method(GATT_CHRC_IFACE, in_signature='aya{sv}',
+                         byte_arrays=True)
     def WriteValue(self, value, options):
         print('Default WriteValue called, returning error')
         raise NotSupportedException()
@@ -198,11 +266,139 @@ class Characteristic(dbus.service.Object):
         print('Default StopNotify called, returning error')
         raise NotSupportedException()
 
+    @dbus.service.method(GATT_CHRC_IFACE,
+                         in_signature='a{sv}',
+                         out_signature='hq')
+    def AcquireNotify(self, options):
+        """
+        Hand BlueZ a socket to read notifications from. The characteristic
+        counts as notifying until BlueZ closes its end.
+        """
+        if not self.acquire_notify:
+            raise NotSupportedException()
+        if self.notify_sock is not None:
+            raise NotPermittedException()
+
+        self.notify_mtu = int(options.get('mtu', DEFAULT_MTU))
+        self.notify_sock, fd = self._acquire(GLib.IO_HUP | GLib.IO_ERR,
+                                             self._on_notify_hup)
+        self.invalidate()
+        # Never block the main loop, a full socket is waited for with a watch
+        self.notify_sock.setblocking(False)
+        self.StartNotify()
+        return fd, dbus.UInt16(self.notify_mtu)
+
+    @dbus.service.method(GATT_CHRC_IFACE,
+                         in_signature='a{sv}',
+                         out_signature='hq')
+    def AcquireWrite(self, options):
+        """
+        Hand BlueZ a socket to write incoming values to, each one is passed
+        on to WriteValue() as bytes
+        """
+        if not self.acquire_write:
+            raise NotSupportedException()
+        if self.write_sock is not None:
+            raise NotPermittedException()
+
+        self.write_mtu = int(options.get('mtu', DEFAULT_MTU))
+        self.write_sock, fd = self._acquire(GLib.IO_IN | GLib.IO_HUP | GLib.IO_ERR,
+                                            self._on_write_sock)
+        self.invalidate()
+        return fd, dbus.UInt16(self.write_mtu)
+
+    def _acquire(self, condition, callback):
+        """
+        :return: our end of a new SEQPACKET socket pair and BlueZ's end as a
+                 dbus UnixFd
+        """
+        ours, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        fd = dbus.types.UnixFd(theirs)
+        theirs.close()
+        GLib.io_add_watch(ours.fileno(), condition, callback)
+        return ours, fd
+
+    def _on_notify_hup(self, fd, condition):
+        print('Notify socket closed')
+        if self.notify_watch is not None:
+            GLib.source_remove(self.notify_watch)
+            self.notify_watch = None
+        self.notify_held = None
+        self.notify_sock.close()
+        self.notify_sock = None
+        self.invalidate()
+        self.StopNotify()
+        return False
+
+    def _on_write_sock(self, fd, condition):
+        if condition & GLib.IO_IN:
+            try:
+                value = self.write_sock.recv(MAX_VALUE_LEN)
+            except OSError as e:
+                print('Write socket error: ' + str(e))
+                value = b''
+            if value:
+                try:
+                    self.WriteValue(value, {'mtu': self.write_mtu})
+                except dbus.exceptions.DBusException as e:
+                    print('Acquired write failed: ' + str(e))
+                return True
+
+        print('Write socket closed')
+        self.write_sock.close()
+        self.write_sock = None
+        self.invalidate()
+        return False
+
     @dbus.service.signal(DBUS_PROP_IFACE,
                          signature='sa{sv}as')
     def PropertiesChanged(self, interface, changed, invalidated):
         pass
 
+    def notify_value(self, value):
+        """
+        Send a notification, value is preferably bytes-like. Goes through the
+        acquired socket if there is one, PropertiesChanged otherwise.
+        A value the socket has no room for is held and sent once it has,
+        then notify_ready() is called. Values sent while one is held are
+        dropped, check notify_held first.
+        :return: False if the value had to be dropped
+        """
+        if self.notify_sock is None:
+            self.PropertiesChanged(GATT_CHRC_IFACE, {'Value': dbus_bytes(value)}, [])
+            return True
+        if self.notify_held is not None:
+            print('Notify socket full, value dropped')
+            return False
+        try:
+            self.notify_sock.send(value)
+        except BlockingIOError:
+            self.notify_held = bytes(value)
+            self.notify_watch = GLib.io_add_watch(self.notify_sock.fileno(), GLib.IO_OUT,
+                                                  self._on_notify_writable)
+        except OSError as e:
+            print('Notify socket error: ' + str(e))
+            return False
+        return True
+
+    def _on_notify_writable(self, fd, condition):
+        try:
+            self.notify_sock.send(self.notify_held)
+        except BlockingIOError:
+            return True
+        except OSError as e:
+            print('Notify socket error: ' + str(e))
+        self.notify_held = None
+        self.notify_watch = None
+        self.notify_ready()
+        return False
+
+    def notify_ready(self):
+        """
+        The notify socket has room again, for subclasses that queue values
+        """
+        pass
+
 
 class Descriptor(dbus.service.Object):
     """
@@ -244,7 +440,8 @@ class Descriptor(dbus.service.Object):
         print ('Default ReadValue called, returning error')
         raise NotSupportedException()
 
-    @dbus.service.method(GATT_DESC_IFACE, in_signature='aya{sv}')
+    @dbus.service.method(GATT_DESC_IFACE, in_signature='aya{sv}',
+                         byte_arrays=True)
     def WriteValue(self, value, options):
         print('Default WriteValue called, returning error')
         raise NotSupportedException()
@@ -279,15 +476,11 @@ class HeartRateMeasurementChrc(Characteristic):
         self.hr_ee_count = 0
 
     def hr_msrmt_cb(self):
-        value = []
-        value.append(dbus.Byte(0x06))
-
-        value.append(dbus.Byte(randint(90, 130)))
+        value = bytearray([0x06, randint(90, 130)])
 
         if self.hr_ee_count % 10 == 0:
-            value[0] = dbus.Byte(value[0] | 0x08)
-            value.append(dbus.Byte(self.service.energy_expended & 0xff))
-            value.append(dbus.Byte((self.service.energy_expended >> 8) & 0xff))
+            value[0] |= 0x08
+            value += self.service.energy_expended.to_bytes(2, 'little')
 
         self.service.energy_expended = \
                 min(0xffff, self.service.energy_expended + 1)
@@ -295,7 +488,7 @@ class HeartRateMeasurementChrc(Characteristic):
 
         print('Updating value: ' + repr(value))
 
-        self.PropertiesChanged(GATT_CHRC_IFACE, { 'Value': value }, [])
+        self.notify_value(value)
 
         return self.notifying
 
@@ -336,7 +529,7 @@ class BodySensorLocationChrc(Characteristic):
 
     def ReadValue(self, options):
         # Return 'Chest' as the sensor location.
-        return [ 0x01 ]
+        return b'\x01'
 
 class HeartRateControlPointChrc(Characteristic):
     HR_CTRL_PT_UUID = '00002a39-0000-1000-8000-00805f9b34fb'
@@ -397,9 +590,7 @@ class BatteryLevelCharacteristic(Characteristic):
     def notify_battery_level(self):
         if not self.notifying:
             return
-        self.PropertiesChanged(
-                GATT_CHRC_IFACE,
-                { 'Value': [dbus.Byte(self.battery_lvl)] }, [])
+        self.notify_value(bytes([self.battery_lvl]))
 
     def drain_battery(self):
         if not self.notifying:
@@ -414,7 +605,7 @@ class BatteryLevelCharacteristic(Characteristic):
 
     def ReadValue(self, options):
         print('Battery Level read: ' + repr(self.battery_lvl))
-        return [dbus.Byte(self.battery_lvl)]
+        return bytes([self.battery_lvl])
 
     def StartNotify(self):
         if self.notifying:
@@ -460,7 +651,7 @@ class TestCharacteristic(Characteristic):
                 self.TEST_CHRC_UUID,
                 ['read', 'write', 'writable-auxiliaries'],
                 service)
-        self.value = []
+        self.value = b''
         self.add_descriptor(TestDescriptor(bus, 0, self))
         self.add_descriptor(
                 CharacteristicUserDescriptionDescriptor(bus, 1, self))
@@ -471,7 +662,7 @@ class TestCharacteristic(Characteristic):
 
     def WriteValue(self, value, options):
         print('TestCharacteristic Write: ' + repr(value))
-        self.value = value
+        self.value = bytes(value)
 
 
 class TestDescriptor(Descriptor):
@@ -489,9 +680,7 @@ class TestDescriptor(Descriptor):
                 characteristic)
 
     def ReadValue(self, options):
-        return [
-                dbus.Byte('T'), dbus.Byte('e'), dbus.Byte('s'), dbus.Byte('t')
-        ]
+        return b'Test'
 
 
 class CharacteristicUserDescriptionDescriptor(Descriptor):
@@ -503,8 +692,7 @@ class CharacteristicUserDescriptionDescriptor(Descriptor):
 
     def __init__(self, bus, index, characteristic):
         self.writable = 'writable-auxiliaries' in characteristic.flags
-        self.value = array.array('B', b'This is a characteristic for testing')
-        self.value = self.value.tolist()
+        self.value = b'This is a characteristic for testing'
         Descriptor.__init__(
                 self, bus, index,
                 self.CUD_UUID,
@@ -517,7 +705,7 @@ class CharacteristicUserDescriptionDescriptor(Descriptor):
     def WriteValue(self, value, options):
         if not self.writable:
             raise NotPermittedException()
-        self.value = value
+        self.value = bytes(value)
 
 class TestEncryptCharacteristic(Characteristic):
     """
@@ -532,7 +720,7 @@ class TestEncryptCharacteristic(Characteristic):
                 self.TEST_CHRC_UUID,
                 ['encrypt-read', 'encrypt-write'],
                 service)
-        self.value = []
+        self.value = b''
         self.add_descriptor(TestEncryptDescriptor(bus, 2, self))
         self.add_descriptor(
                 CharacteristicUserDescriptionDescriptor(bus, 3, self))
@@ -543,7 +731,7 @@ class TestEncryptCharacteristic(Characteristic):
 
     def WriteValue(self, value, options):
         print('TestEncryptCharacteristic Write: ' + repr(value))
-        self.value = value
+        self.value = bytes(value)
 
 class TestEncryptDescriptor(Descriptor):
     """
@@ -560,9 +748,7 @@ class TestEncryptDescriptor(Descriptor):
                 characteristic)
 
     def ReadValue(self, options):
-        return [
-                dbus.Byte('T'), dbus.Byte('e'), dbus.Byte('s'), dbus.Byte('t')
-        ]
+        return b'Test'
 
 
 class TestSecureCharacteristic(Characteristic):
@@ -578,7 +764,7 @@ class TestSecureCharacteristic(Characteristic):
                 self.TEST_CHRC_UUID,
                 ['secure-read', 'secure-write'],
                 service)
-        self.value = []
+        self.value = b''
         self.add_descriptor(TestSecureDescriptor(bus, 2, self))
         self.add_descriptor(
                 CharacteristicUserDescriptionDescriptor(bus, 3, self))
@@ -589,7 +775,7 @@ class TestSecureCharacteristic(Characteristic):
 
     def WriteValue(self, value, options):
         print('TestSecureCharacteristic Write: ' + repr(value))
-        self.value = value
+        self.value = bytes(value)
 
 
 class TestSecureDescriptor(Descriptor):
@@ -607,9 +793,18 @@ class TestSecureDescriptor(Descriptor):
                 characteristic)
 
     def ReadValue(self, options):
-        return [
-                dbus.Byte('T'), dbus.Byte('e'), dbus.Byte('s'), dbus.Byte('t')
-        ]
+        return b'Test'
+
+class ExampleApplication(Application):
+    """
+    Application exposing the example services above
+    """
+    def __init__(self, bus):
+        Application.__init__(self, bus)
+        self.add_service(HeartRateService(bus, 0))
+        self.add_service(BatteryService(bus, 1))
+        self.add_service(TestService(bus, 2))
+
 
 def register_app_cb():
     print('GATT application registered')
@@ -647,7 +842,7 @@ def main():
             bus.get_object(BLUEZ_SERVICE_NAME, adapter),
             GATT_MANAGER_IFACE)
 
-    app = Application(bus)
+    app = ExampleApplication(bus)
 
     mainloop = GObject.MainLoop()
 
@@ -0,0 +1,160 @@
+"""
+Single process hub: the UART server and the USB and BLE bridges in one
+interpreter, instead of the three that main.py starts.
+
+One GLib main loop runs the UartServer and the BLE bridge. The BLE bridge
+needs GLib anyway, because dbus-python only dispatches there, and it
+already watches its ZMQ socket with GLib.io_add_watch. The UartServer is
+driven the same way: watches on the serial port and its ZMQ sockets, and a
+timeout for coalescing and resends. The USB bridge blocks in libusb, so it
+keeps its threads. All of them share one ZMQ context and switch
+endpoints.py to inproc:// sockets. Those hand messages between threads in
+memory, with no trip through the kernel.
+
+    python3 hub.py [--port /dev/ttyS0] [--credit] [--no-usb] [--no-ble]
+"""
+import math
+import time
+import logging
+import argparse
+import threading
+
+import zmq
+from gi.repository import GLib
+
+import endpoints
+from uart import UartServer
+
+log = logging.getLogger("hub")
+
+
+def pending(skt):
+    return skt.getsockopt(zmq.EVENTS) & zmq.POLLIN
+
+
+class GlibUart:
+    """
+    Runs a UartServer on the GLib main loop instead of its own run_poller()
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.uart_fd = server.uart.fileno()
+        self.uart_watch = None
+        self.idle = None
+        self.timer = None
+        self.timer_due = None
+        self.sockets = [server.in_skt]
+        if server.ledger is not None:
+            self.sockets.append(server.credit_skt)
+        self.watches = [GLib.io_add_watch(skt.getsockopt(zmq.FD), GLib.IO_IN, self.on_ready)
+                        for skt in self.sockets]
+        self.schedule()
+
+    def on_ready(self, fd, condition):
+        self.schedule()
+        return True
+
+    def schedule(self):
+        if self.idle is None:
+            self.idle = GLib.idle_add(self.service, priority=GLib.PRIORITY_DEFAULT)
+
+    def service(self):
+        self.idle = None
+        self.server.service()
+
+        # Only watch the uart while its data has somewhere to go, else it
+        # backs up in the driver / behind RTS
+        reading = bool(self.server.read_budget(1))
+        if reading and self.uart_watch is None:
+            self.uart_watch = GLib.io_add_watch(self.uart_fd, GLib.IO_IN, self.on_ready)
+        elif not reading and self.uart_watch is not None:
+            GLib.source_remove(self.uart_watch)
+            self.uart_watch = None
+
+        # ZMQ's fd only signals new events, come back for whatever
+        # MAX_BATCH left behind
+        if any(pending(skt) for skt in self.sockets):
+            self.schedule()
+
+        # Keep the earliest wakeup coalescing, resends and credit expiry need
+        timeout = self.server.poll_timeout()
+        due = time.monotonic() + timeout / 1000
+        if self.timer is None or due < self.timer_due:
+            if self.timer is not None:
+                GLib.source_remove(self.timer)
+            self.timer = GLib.timeout_add(math.ceil(timeout), self.on_timer)
+            self.timer_due = due
+        return False
+
+    def on_timer(self):
+        self.timer = None
+        self.schedule()
+        return False
+
+    def close(self):
+        for source in self.watches + [self.uart_watch, self.idle, self.timer]:
+            if source is not None:
+                GLib.source_remove(source)
+        self.watches = []
+        self.uart_watch = self.idle = self.timer = None
+
+
+def start_usb():
+    import android2
+
+    thread = threading.Thread(target=android2.main, name="usb", daemon=True)
+    thread.start()
+    return thread
+
+
+def start_ble():
+    """
+    :return: the BLE bridge's advertisement, None without an adapter
+    """
+    import bluetooth2
+
+    return bluetooth2.start()
+
+
+def stop_ble():
+    import bluetooth2
+
+    bluetooth2.credits.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", default="/dev/ttyS0", help="serial port to open")
+    parser.add_argument("--credit", action="store_true",
+                        help="credit based flow control towards the bridges")
+    parser.add_argument("--no-usb", action="store_true", help="leave out the USB accessory bridge")
+    parser.add_argument("--no-ble", action="store_true", help="leave out the BLE bridge")
+    args = parser.parse_args()
+
+    # Everyone shares the process and its zmq context, the uart sockets
+    # must be bound before the bridges connect
+    endpoints.TRANSPORT = "inproc"
+    server = UartServer(port=args.port, credit=args.credit, ctx=zmq.Context.instance())
+    if not args.no_usb:
+        start_usb()
+    adv = None if args.no_ble else start_ble()
+
+    uart = GlibUart(server)
+    loop = GLib.MainLoop()
+    try:
+        loop.run()
+    except KeyboardInterrupt:
+        if adv is not None:
+            adv.Release()
+    finally:
+        uart.close()
+        if adv is not None:
+            stop_ble()
+        log.info("Hub stopped: {}".format(server.stats()))
+        server.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,9 @@
 import subprocess
 import time
 
+# Run the uart server and both bridges in one process (hub.py) instead of three
+SINGLE_PROCESS = False
+
 def start_uart_server():
     subprocess.Popen(["python", "/home/pi/Dev/pi/zmq/uart.py"])
 
@@ -10,11 +13,17 @@ def start_usb_host_process():
 def start_bluetoothLE_process():
     subprocess.Popen(["python", "/home/pi/Dev/pi/zmq/bluetooth2.py"])
 
+def start_hub():
+    subprocess.Popen(["python", "/home/pi/Dev/pi/zmq/hub.py"])
+
 
 # Start the components in the desired order
-start_uart_server()
-time.sleep(0.5)  # Wait for the server to start
-start_usb_host_process()
-start_bluetoothLE_process()
+if SINGLE_PROCESS:
+    start_hub()
+else:
+    start_uart_server()
+    time.sleep(0.5)  # Wait for the server to start
+    start_usb_host_process()
+    start_bluetoothLE_process()
 
-# Continue with any other necessary startup tasks
\ No newline at end of file
+# Continue with any other necessary startup tasks
@@ -1,47 +1,558 @@
+import os
 import zmq
+import time
+import select
 import serial
 import logging
+import binascii
+import collections
+
+import endpoints
+from credit import CreditLedger
 
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger("uart")
 
+# Upper bound on messages / serial reads handled per wakeup, so a flood on one
+# side can't starve the other
+MAX_BATCH = 64
+
+# Poll timeout (ms) so run_poller() notices stop() without traffic
+POLL_TIMEOUT = 500
+
+# Longest encoded frame accepted from the uart before the decoder gives up
+# and resynchronises on the next delimiter
+MAX_FRAME = 4096
+
+FRAME_DELIMITER = b"\x00"
+
+# Size of the reusable receive buffer used in zero copy mode. Kept below
+# zmq.COPY_THRESHOLD: libzmq then takes its own copy of each slice inside
+# send(), so the buffer can be refilled as soon as send() returns.
+RX_BUFFER_SIZE = min(4096, zmq.COPY_THRESHOLD - 1)
+
+# Poll timeout (ms) while a message the PUB side refused waits to be resent
+RETRY_TIMEOUT = 10
+
+# Write coalescing defaults: largest merged write and the longest (seconds) a
+# message may wait for company. 0 only merges what is already queued.
+COALESCE_BYTES = 1024
+COALESCE_DELAY = 0.0
+
+
+def crc16(data):
+    """
+    CRC-16/CCITT-FALSE (poly 0x1021, init 0xFFFF)
+    """
+    return binascii.crc_hqx(data, 0xFFFF)
+
+
+def cobs_encode(data):
+    """
+    Consistent overhead byte stuffing, the result contains no zero bytes
+    :param data: bytes-like payload
+    :return: encoded bytes, without the trailing delimiter
+    """
+    out = bytearray()
+    for block in bytes(data).split(b"\x00"):
+        while len(block) >= 0xFE:
+            out.append(0xFF)
+            out += block[:0xFE]
+            block = block[0xFE:]
+        out.append(len(block) + 1)
+        out += block
+    return bytes(out)
+
+
+def cobs_decode(data):
+    """
+    Reverse of cobs_encode
+    :param data: encoded bytes, without the delimiter
+    :return: decoded bytes
+    :raises ValueError: if data isn't valid COBS
+    """
+    out = bytearray()
+    i, size = 0, len(data)
+    while i < size:
+        code = data[i]
+        if code == 0 or i + code > size:
+            raise ValueError("bad COBS block at offset {}".format(i))
+        out += data[i + 1:i + code]
+        i += code
+        if code < 0xFF and i < size:
+            out.append(0)
+    return bytes(out)
+
+
+def encode_frame(message):
+    """
+    Frame a message for the uart: COBS(message + crc16) + delimiter
+    """
+    return cobs_encode(bytes(message) + crc16(message).to_bytes(2, "big")) + FRAME_DELIMITER
+
+
+class FrameDecoder:
+    """
+    Reassembles frames written by encode_frame() out of arbitrary uart chunks
+    and verifies their CRC. Keeps counters so link quality can be monitored.
+    """
+
+    def __init__(self, max_frame=MAX_FRAME):
+        self.max_frame = max_frame
+        self.buffer = bytearray()
+        self.frames = 0
+        self.crc_errors = 0
+        self.framing_errors = 0
+        self.overruns = 0
+
+    def feed(self, data):
+        """
+        :param data: bytes read from the uart
+        :return: list of whole, verified messages
+        """
+        self.buffer += data
+        messages = []
+        while True:
+            end = self.buffer.find(FRAME_DELIMITER)
+            if end < 0:
+                break
+            frame = bytes(self.buffer[:end])
+            del self.buffer[:end + 1]
+            if frame:
+                message = self.decode(frame)
+                if message is not None:
+                    messages.append(message)
+
+        if len(self.buffer) > self.max_frame:
+            self.overruns += 1
+            log.warning("Frame overrun, dropped {} bytes".format(len(self.buffer)))
+            self.buffer.clear()
+        return messages
+
+    def decode(self, frame):
+        try:
+            payload = cobs_decode(frame)
+        except ValueError as e:
+            self.framing_errors += 1
+            log.warning("Framing error: {}".format(e))
+            return None
+        if len(payload) < 2:
+            self.framing_errors += 1
+            log.warning("Framing error: short frame")
+            return None
+
+        message, crc = payload[:-2], int.from_bytes(payload[-2:], "big")
+        if crc16(message) != crc:
+            self.crc_errors += 1
+            log.warning("CRC error ({} of {} frames)".format(
+                self.crc_errors, self.frames + self.crc_errors))
+            return None
+        self.frames += 1
+        return message
+
+    def stats(self):
+        return {
+            "frames": self.frames,
+            "crc_errors": self.crc_errors,
+            "framing_errors": self.framing_errors,
+            "overruns": self.overruns,
+        }
+
+
+class CoalescingWriter:
+    """
+    Merges small messages into a single uart write. A merged write goes out
+    once it reaches max_bytes or the oldest pending message has waited
+    max_delay seconds, whichever comes first.
+    """
+
+    def __init__(self, write, max_bytes=COALESCE_BYTES, max_delay=COALESCE_DELAY):
+        """
+        :param write: callable doing the actual write
+        :param max_bytes: flush as soon as this many bytes are pending
+        :param max_delay: longest a message is held back, in seconds
+        """
+        self.write = write
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+        self.pending = []
+        self.pending_bytes = 0
+        self.deadline = None
+        self.writes = 0
+        self.messages = 0
+        self.messages_per_write = collections.Counter()
+
+    def add(self, data):
+        if self.pending and self.pending_bytes + len(data) > self.max_bytes:
+            self.flush()
+        if not self.pending:
+            self.deadline = time.monotonic() + self.max_delay
+        self.pending.append(data)
+        self.pending_bytes += len(data)
+        if self.pending_bytes >= self.max_bytes:
+            self.flush()
+
+    def timeout(self):
+        """
+        :return: ms until the pending data is due, None if nothing is pending
+        """
+        if not self.pending:
+            return None
+        return max(0, (self.deadline - time.monotonic()) * 1000)
+
+    def flush_due(self):
+        if self.pending and time.monotonic() >= self.deadline:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        count = len(self.pending)
+        data = self.pending[0] if count == 1 else b"".join(self.pending)
+        self.pending = []
+        self.pending_bytes = 0
+        self.deadline = None
+        self.write(data)
+        self.writes += 1
+        self.messages += count
+        self.messages_per_write[count] += 1
+
+    def stats(self):
+        return {
+            "writes": self.writes,
+            "messages": self.messages,
+            "messages_per_write": dict(self.messages_per_write),
+            "avg_messages_per_write": self.messages / self.writes if self.writes else 0.0,
+        }
+
 
 class UartServer:
     """
     Proxy server for the UART.
+
+    A message to the uart may come in an envelope, [sender, data], as the
+    USB sessions send them. Only the last frame goes to the uart.
     """
 
-    def __init__(self, port="/dev/ttyS0"):
+    def __init__(self, port="/dev/ttyS0", in_addr=None, out_addr=None,
+                 framed=False, coalesce=False, coalesce_bytes=COALESCE_BYTES,
+                 coalesce_delay=COALESCE_DELAY, zero_copy=False, credit=False,
+                 credit_addr=None, rtscts=False, ctx=None):
         """
         Initialize the sockets to listen and publish
         :param port: serial port to open
+        :param in_addr: address the SUB socket binds to (data to the uart),
+                        the endpoints.TO_UART one when None
+        :param out_addr: address the PUB socket binds to (data from the uart),
+                         the endpoints.FROM_UART one when None
+        :param framed: use COBS + CRC16 frames on the uart, one message per ZMQ frame
+        :param coalesce: merge messages headed to the uart into fewer writes
+        :param coalesce_bytes: largest merged write
+        :param coalesce_delay: longest a message may be held back, in seconds
+        :param zero_copy: write straight from the ZMQ frames and read the uart
+                          into a reusable buffer instead of fresh bytes objects
+        :param credit: only read the uart as fast as the consumers grant credit,
+                       see credit.py
+        :param credit_addr: address the credit PULL socket binds to, the
+                            endpoints.CREDIT one when None
+        :param rtscts: hardware flow control, so the device stops sending
+                       while the hub isn't reading
+        :param ctx: zmq context to use, needed for inproc:// addresses. A
+                    context of our own is created (and terminated by close())
+                    when None.
         """
-        ctx = zmq.Context()
-        self.in_skt = ctx.socket(zmq.SUB)
-        self.in_skt.bind("tcp://*:5555")
+        self.own_ctx = ctx is None
+        self.ctx = zmq.Context() if ctx is None else ctx
+        self.in_skt = self.ctx.socket(zmq.SUB)
+        self.in_skt.bind(in_addr or endpoints.bind_addr(endpoints.TO_UART))
         self.in_skt.setsockopt_string(zmq.SUBSCRIBE, "")
 
-        self.out_skt = ctx.socket(zmq.PUB)
-        self.out_skt.bind("tcp://*:5556")
+        self.ledger = None
+        self.unsent = collections.deque()
+        self.send_stalls = 0
+        if credit:
+            # XPUB_NODROP makes a full subscriber queue an error we can see
+            # and retry instead of a silent drop
+            self.out_skt = self.ctx.socket(zmq.XPUB)
+            self.out_skt.setsockopt(zmq.XPUB_NODROP, 1)
+            self.credit_skt = self.ctx.socket(zmq.PULL)
+            self.credit_skt.bind(credit_addr or endpoints.bind_addr(endpoints.CREDIT))
+            self.ledger = CreditLedger()
+        else:
+            self.out_skt = self.ctx.socket(zmq.PUB)
+        self.out_skt.bind(out_addr or endpoints.bind_addr(endpoints.FROM_UART))
 
-        self.uart = serial.Serial(port, 115200)
+        self.uart = serial.Serial(port, 115200, rtscts=rtscts)
+        self.decoder = FrameDecoder() if framed else None
 
-    def run(self):
-        while True:
+        self.zero_copy = zero_copy
+        self.write_raw = self.uart.write
+        if zero_copy:
+            self.rx_view = memoryview(bytearray(RX_BUFFER_SIZE))
+            if hasattr(self.uart, "fd"):
+                # pyserial's write() and readinto() both copy, go to the fd
+                self.write_raw = self.write_fd
+
+        self.writer = None
+        if coalesce:
+            self.writer = CoalescingWriter(self.write_raw, coalesce_bytes, coalesce_delay)
+        self.running = False
+
+    def run(self, mode="poll"):
+        """
+        Run the proxy until stop() is called
+        :param mode: "poll" blocks on a zmq.Poller, "spin" is the old busy loop
+        """
+        if mode == "spin":
+            self.run_spin()
+        else:
+            self.run_poller()
+
+    def stop(self):
+        self.running = False
+
+    def close(self):
+        """
+        Release the sockets and the serial port, call after run() returned
+        """
+        if self.writer is not None:
+            self.writer.flush()
+        self.in_skt.close(linger=0)
+        self.out_skt.close(linger=0)
+        if self.ledger is not None:
+            self.credit_skt.close(linger=0)
+        if self.own_ctx:
+            self.ctx.term()
+        self.uart.close()
+
+    def run_spin(self):
+        self.running = True
+        while self.running:
             try:
-                data = self.in_skt.recv(flags=zmq.NOBLOCK)
-                log.info("Got:{}".format(data))
+                data = self.in_skt.recv_multipart(flags=zmq.NOBLOCK)[-1]
+                if log.isEnabledFor(logging.DEBUG):
+                    log.debug("Got:%s", bytes(data))
             except zmq.ZMQError:
                 pass
             else:
-                self.uart.write(data)
+                self.write_uart(data)
+            if self.writer is not None:
+                self.writer.flush_due()
+
+            if self.ledger is not None:
+                self.drain_credits()
+                self.ledger.expire()
+                self.resend()
+            waiting = self.read_budget(self.uart.in_waiting)
+            if waiting:
+                self.publish(self.read_uart(waiting))
+
+    def run_poller(self):
+        """
+        Sleep on a single poller covering the SUB socket and the serial fd,
+        only waking up when either side has data.
+        """
+        uart_fd = self.uart.fileno()
+        poller = zmq.Poller()
+        poller.register(self.in_skt, zmq.POLLIN)
+        if self.ledger is not None:
+            poller.register(self.credit_skt, zmq.POLLIN)
+
+        self.running = True
+        while self.running:
+            # Only watch the uart while its data has somewhere to go, else
+            # it backs up in the driver / behind RTS
+            poller.register(uart_fd, zmq.POLLIN if self.read_budget(1) else 0)
+            events = dict(poller.poll(self.poll_timeout()))
+            if self.in_skt in events:
+                self.drain_socket()
+            if self.writer is not None:
+                self.writer.flush_due()
+            if self.ledger is not None:
+                if self.credit_skt in events:
+                    self.drain_credits()
+                self.ledger.expire()
+                self.resend()
+            if uart_fd in events:
+                self.drain_uart()
+
+    def service(self):
+        """
+        Handle whatever is ready without waiting, for running the server
+        from another event loop (see hub.py). Call again when a socket or
+        the uart becomes readable, and at the latest after poll_timeout() ms.
+        """
+        self.drain_socket()
+        if self.writer is not None:
+            self.writer.flush_due()
+        if self.ledger is not None:
+            self.drain_credits()
+            self.ledger.expire()
+            self.resend()
+        self.drain_uart()
+
+    def poll_timeout(self):
+        """
+        Wake up in time for pending coalesced data or a resend, POLL_TIMEOUT
+        otherwise
+        """
+        timeout = RETRY_TIMEOUT if self.unsent else POLL_TIMEOUT
+        due = self.writer.timeout() if self.writer is not None else None
+        return timeout if due is None else min(timeout, due)
+
+    def drain_credits(self):
+        for _ in range(MAX_BATCH):
+            if not self.credit_skt.getsockopt(zmq.EVENTS) & zmq.POLLIN:
+                return
+            self.ledger.handle(self.credit_skt.recv_multipart(flags=zmq.NOBLOCK))
+
+    def read_budget(self, waiting):
+        """
+        :return: how many of the waiting uart bytes may be read right now
+        """
+        if self.unsent:
+            return 0
+        available = self.ledger.available() if self.ledger is not None else None
+        if available is None:
+            return waiting
+        return max(0, min(waiting, available))
+
+    def drain_socket(self):
+        """
+        Write up to MAX_BATCH pending ZMQ messages to the uart
+        """
+        for _ in range(MAX_BATCH):
+            # Checking EVENTS is cheaper than letting recv() raise zmq.Again
+            if not self.in_skt.getsockopt(zmq.EVENTS) & zmq.POLLIN:
+                return
+            data = self.in_skt.recv_multipart(flags=zmq.NOBLOCK, copy=not self.zero_copy)[-1]
+            if self.zero_copy:
+                data = data.buffer
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("Got:%s", bytes(data))
+            self.write_uart(data)
+
+    def drain_uart(self):
+        """
+        Publish up to MAX_BATCH chunks of whatever the uart has buffered
+        """
+        for _ in range(MAX_BATCH):
+            waiting = self.read_budget(self.uart.in_waiting)
+            if not waiting:
+                return
+            self.publish(self.read_uart(waiting))
+
+    def read_uart(self, size):
+        """
+        :return: bytes, or in zero copy mode a view of the receive buffer that
+                 is only valid until the next read
+        """
+        if not self.zero_copy:
+            return self.uart.read(size)
+        view = self.rx_view[:size]
+        if hasattr(self.uart, "fd"):
+            return self.rx_view[:os.readv(self.uart.fd, [view])]
+        return self.rx_view[:self.uart.readinto(view)]
+
+    def write_fd(self, data):
+        """
+        Write a bytes-like object to the serial fd without copying it
+        """
+        view = memoryview(data)
+        while view:
+            try:
+                view = view[os.write(self.uart.fd, view):]
+            except BlockingIOError:
+                select.select([], [self.uart.fd], [])
+
+    def write_uart(self, data):
+        if self.decoder is not None:
+            data = encode_frame(data)
+        if self.writer is not None:
+            self.writer.add(data)
+        else:
+            self.write_raw(data)
+
+    def publish(self, data):
+        """
+        Send uart data to the subscribers, whole messages only when framed
+        """
+        if self.decoder is None:
+            self.send_out(data)
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("Sent:%s", bytes(data))
+            return
+        for message in self.decoder.feed(data):
+            self.send_out(message)
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("Sent:%s", bytes(message))
+
+    def send_out(self, data):
+        if self.ledger is None:
+            self.out_skt.send(data, copy=not self.zero_copy)
+            return
+        if not self.unsent:
+            try:
+                self.out_skt.send(data, flags=zmq.NOBLOCK, copy=not self.zero_copy)
+            except zmq.Again:
+                self.send_stalls += 1
+                log.warning("Subscriber queue full, holding {} bytes".format(len(data)))
+            else:
+                self.ledger.consume(len(data))
+                return
+        self.unsent.append(bytes(data))
 
-            if self.uart.in_waiting:
-                data = self.uart.read(self.uart.in_waiting)
-                self.out_skt.send(data)
-                log.info("Sent:{}".format(data))
+    def resend(self):
+        """
+        Retry messages the XPUB socket refused, in order
+        """
+        while self.unsent:
+            try:
+                self.out_skt.send(self.unsent[0], flags=zmq.NOBLOCK)
+            except zmq.Again:
+                return
+            self.ledger.consume(len(self.unsent.popleft()))
+
+    def stats(self):
+        """
+        Counters of the optional framing and coalescing stages
+        """
+        stats = {}
+        if self.decoder is not None:
+            stats["framing"] = self.decoder.stats()
+        if self.writer is not None:
+            stats["coalescing"] = self.writer.stats()
+        if self.ledger is not None:
+            stats["credit"] = dict(self.ledger.stats(), send_stalls=self.send_stalls,
+                                   unsent=len(self.unsent))
+        return stats
 
 
 if __name__ == "__main__":
-    server = UartServer()
-    server.run()
+    import argparse
+
+    parser = argparse.ArgumentParser(description="ZMQ <-> UART proxy")
+    parser.add_argument("--port", default="/dev/ttyS0", help="serial port to open")
+    parser.add_argument("--mode", choices=("poll", "spin"), default="poll",
+                        help="event loop: poll (default) or the old busy loop")
+    parser.add_argument("--framed", action="store_true",
+                        help="COBS + CRC16 framing on the uart")
+    parser.add_argument("--coalesce", action="store_true",
+                        help="merge small messages into fewer uart writes")
+    parser.add_argument("--coalesce-bytes", type=int, default=COALESCE_BYTES,
+                        help="largest merged write (default %(default)s)")
+    parser.add_argument("--coalesce-delay", type=float, default=COALESCE_DELAY * 1000,
+                        help="max latency added by coalescing, ms (default %(default)s)")
+    parser.add_argument("--zero-copy", action="store_true",
+                        help="avoid per-message copies between ZMQ and the uart")
+    parser.add_argument("--credit", action="store_true",
+                        help="credit based flow control towards the consumers")
+    parser.add_argument("--rtscts", action="store_true",
+                        help="RTS/CTS hardware flow control on the uart")
+    args = parser.parse_args()
+
+    server = UartServer(port=args.port, framed=args.framed, coalesce=args.coalesce,
+                        coalesce_bytes=args.coalesce_bytes,
+                        coalesce_delay=args.coalesce_delay / 1000,
+                        zero_copy=args.zero_copy, credit=args.credit, rtscts=args.rtscts)
+    server.run(args.mode)
@@ -0,0 +1,160 @@
+"""
+Asynchronous bulk IN transfers on top of pyusb's libusb1 backend.
+
+pyusb only offers synchronous reads, which leave the bus idle between the
+end of one transfer and the next read() call. AsyncBulkReader keeps several
+transfers queued in libusb instead, so the host controller always has a
+buffer to fill.
+"""
+import ctypes
+
+import usb.core
+import usb.backend.libusb1 as libusb1
+
+# Transfers kept in flight and the size of each one
+ASYNC_DEPTH = 4
+ASYNC_TRANSFER_SIZE = 16384
+
+# How long (ms) one libusb event loop pass may block, bounds how late a stop
+# request is noticed
+EVENT_TIMEOUT = 100
+
+LIBUSB_TRANSFER_TYPE_BULK = 2
+LIBUSB_TRANSFER_COMPLETED = 0
+LIBUSB_TRANSFER_TIMED_OUT = 2
+
+
+class _timeval(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long),
+                ('tv_usec', ctypes.c_long)]
+
+
+def _setup_prototypes(lib):
+    """
+    pyusb leaves these out, it never cancels or polls with a timeout
+    """
+    lib.libusb_cancel_transfer.argtypes = [libusb1._libusb_transfer_p]
+    lib.libusb_handle_events_timeout.argtypes = [ctypes.c_void_p, ctypes.POINTER(_timeval)]
+
+
+def supported(device):
+    """
+    :return: True if the device sits on pyusb's libusb1 backend
+    """
+    return isinstance(device._ctx.backend, libusb1._LibUSB)
+
+
+class AsyncBulkReader:
+    """
+    Keeps depth bulk IN transfers queued on an endpoint and hands completed
+    buffers to a callback, in submission order.
+    """
+
+    def __init__(self, device, endpoint, depth=ASYNC_DEPTH, size=ASYNC_TRANSFER_SIZE):
+        """
+        :param device: pyusb device, must use the libusb1 backend
+        :param endpoint: pyusb bulk IN endpoint, or anything else with its
+                         bEndpointAddress and wMaxPacketSize
+        :param depth: number of transfers kept in flight
+        :param size: buffer size of each transfer, rounded down to whole packets
+        """
+        backend = device._ctx.backend
+        self.lib = backend.lib
+        self.ctx = backend.ctx
+        _setup_prototypes(self.lib)
+
+        # Opens the device and claims the interface the same way read() would.
+        # By address, pyusb only unwraps its own Endpoint objects
+        device._ctx.setup_request(device, endpoint.bEndpointAddress)
+        handle = device._ctx.handle.handle
+
+        size = max(endpoint.wMaxPacketSize, size // endpoint.wMaxPacketSize * endpoint.wMaxPacketSize)
+        self.size = size
+        self.error = None
+        self.slots = []
+        self.queue = []
+        self.by_address = {}
+        # One callback object for all transfers, it must outlive them
+        self.callback = libusb1._libusb_transfer_cb_fn_p(self._on_complete)
+
+        for _ in range(depth):
+            buf = ctypes.create_string_buffer(size)
+            transfer = self.lib.libusb_alloc_transfer(0)
+            t = transfer.contents
+            t.dev_handle = handle
+            t.endpoint = endpoint.bEndpointAddress
+            t.type = LIBUSB_TRANSFER_TYPE_BULK
+            t.timeout = 0
+            t.buffer = ctypes.cast(buf, ctypes.c_void_p)
+            t.length = size
+            t.callback = self.callback
+            t.num_iso_packets = 0
+            slot = {"transfer": transfer, "buffer": buf, "view": memoryview(buf).cast('B'),
+                    "done": False, "active": False}
+            self.slots.append(slot)
+            self.by_address[ctypes.addressof(t)] = slot
+
+    def _on_complete(self, transfer):
+        slot = self.by_address[ctypes.addressof(transfer.contents)]
+        slot["done"] = True
+        slot["active"] = False
+
+    def _submit(self, slot):
+        slot["done"] = False
+        slot["active"] = True
+        libusb1._check(self.lib.libusb_submit_transfer(slot["transfer"]))
+        self.queue.append(slot)
+
+    def _deliver(self, deliver):
+        """
+        Hand completed transfers at the head of the queue to deliver() and
+        queue them again
+        """
+        while self.queue and self.queue[0]["done"]:
+            slot = self.queue.pop(0)
+            t = slot["transfer"].contents
+            if t.status == LIBUSB_TRANSFER_COMPLETED:
+                if t.actual_length:
+                    deliver(slot["view"][:t.actual_length])
+            elif t.status != LIBUSB_TRANSFER_TIMED_OUT:
+                self.error = usb.core.USBError(libusb1._str_transfer_error[t.status],
+                                               t.status, libusb1._transfer_errno[t.status])
+                return
+            self._submit(slot)
+
+    def run(self, deliver, running):
+        """
+        Read until running() returns False or the device fails
+        :param deliver: called with a memoryview on each completed transfer's
+                        buffer, only valid until deliver returns
+        :param running: called once per event loop pass
+        :raises usb.core.USBError: when a transfer fails, e.g. on disconnect
+        """
+        tv = _timeval(0, EVENT_TIMEOUT * 1000)
+        try:
+            for slot in self.slots:
+                self._submit(slot)
+            while running() and self.error is None:
+                libusb1._check(self.lib.libusb_handle_events_timeout(self.ctx, ctypes.byref(tv)))
+                self._deliver(deliver)
+        finally:
+            self.close()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        """
+        Cancel whatever is still in flight and free the transfers
+        """
+        tv = _timeval(0, EVENT_TIMEOUT * 1000)
+        for slot in self.slots:
+            if slot["active"]:
+                self.lib.libusb_cancel_transfer(slot["transfer"])
+        while any(slot["active"] for slot in self.slots):
+            if self.lib.libusb_handle_events_timeout(self.ctx, ctypes.byref(tv)) < 0:
+                break
+        for slot in self.slots:
+            if not slot["active"]:     # leak rather than free under libusb's feet
+                self.lib.libusb_free_transfer(slot["transfer"])
+        self.slots = []
+        self.queue = []
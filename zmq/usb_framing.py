@@ -0,0 +1,76 @@
+"""
+Length-prefixed messages over the AOA bulk stream.
+
+A bulk read returns whatever the phone has sent so far, so one read can hold
+part of a message or several of them. Each message goes over USB as a 4 byte
+big-endian length followed by the payload, and MessageDecoder puts the
+messages back together however the reads cut them.
+"""
+import struct
+import logging
+
+log = logging.getLogger("usb_framing")
+
+HEADER = struct.Struct(">I")
+
+# Longest message accepted, a bigger length means the stream is out of sync
+MAX_MESSAGE = 16 * 1024 * 1024
+
+
+def encode_message(payload):
+    return HEADER.pack(len(payload)) + payload
+
+
+class MessageDecoder:
+    """
+    Reassembles length-prefixed messages from a stream of bulk reads
+    """
+
+    def __init__(self, max_message=MAX_MESSAGE):
+        self.max_message = max_message
+        self.buffer = bytearray()
+        self.messages = 0
+        self.resyncs = 0
+        self.dropped_bytes = 0
+
+    def feed(self, data):
+        """
+        :param data: bytes-like, only read during the call
+        :return: the messages completed by data, as bytes
+        """
+        self.buffer += data
+        messages = []
+        offset = 0
+        oversized = None
+        with memoryview(self.buffer) as view:
+            while len(view) - offset >= HEADER.size:
+                length, = HEADER.unpack_from(view, offset)
+                if length > self.max_message:
+                    oversized = length
+                    break
+                end = offset + HEADER.size + length
+                if end > len(view):
+                    break
+                messages.append(bytes(view[offset + HEADER.size:end]))
+                offset = end
+
+        if oversized is not None:
+            # Nothing in the stream marks where the next message starts, all
+            # that can be done is start over with the next read
+            self.resyncs += 1
+            self.dropped_bytes += len(self.buffer) - offset
+            log.warning("Message length {} over {}, dropped {} bytes".format(
+                oversized, self.max_message, len(self.buffer) - offset))
+            self.buffer.clear()
+        elif offset:
+            del self.buffer[:offset]
+        self.messages += len(messages)
+        return messages
+
+    def stats(self):
+        return {
+            "messages": self.messages,
+            "buffered": len(self.buffer),
+            "resyncs": self.resyncs,
+            "dropped_bytes": self.dropped_bytes,
+        }